@@ -0,0 +1,486 @@
+"""A local stand-in for the parts of the Mastodon API the bot uses
+
+Only what Bot calls is implemented: instance and credentials lookups,
+mention notifications with min_id/since_id/max_id paging, the user stream
+(mentions only), posting statuses, and the async media API, where uploads
+stay "processing" for a configurable delay. Entry images are served from
+memory under /files/. Every API request is counted per endpoint. State
+lives in FakeInstance, which the drivers use to inject mentions and to
+take the stream down.
+
+FakeServer serves an instance from a thread of the driver's process.
+FakeProcess runs one in a process of its own, so the server does not take
+the GIL from the bot it is measuring; it is driven over /_fake/ routes.
+
+Usage: python benchmarks/fakemastodon.py [--bot-acct ACCT] [--processing-delay SECONDS]
+prints the base URL, then serves until killed.
+"""
+import argparse
+import collections
+import datetime
+import email.parser
+import email.policy
+import functools
+import http.server
+import itertools
+import json
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from collections.abc import Sequence
+from email.utils import collapse_rfc2231_value
+from urllib.parse import parse_qs, urlparse
+
+import httpx
+
+VERSION = '4.3.0'
+
+# Statuses, notifications and media share one sequence, like Mastodon's snowflake ids
+FIRST_ID = 110_000_000_000_000_000
+# Streams send a heartbeat this often, which is also how soon a dropped client is noticed
+HEARTBEAT_SECONDS = 1.0
+
+
+class FakeInstance:
+    """State of the fake server"""
+
+    def __init__(self, domain: str = 'fake.local', bot_acct: str = 'picrew', processing_delay: float = 0.0):
+        self.domain = domain
+        self.processing_delay = processing_delay
+        self.base_url = ''  # set once the server is listening
+        self.lock = threading.Lock()
+        self.ids = itertools.count(FIRST_ID)
+
+        self.bot = self.account(bot_acct)
+        self.statuses: dict[str, dict] = {}
+        self.notifications: list[dict] = []  # oldest first
+        self.media: dict[str, tuple[dict, float]] = {}  # id: attachment, ready at
+        self.files: dict[str, tuple[bytes, str]] = {}  # name: body, content type
+        self.streams: list[queue.Queue[dict | None]] = []  # events of each open stream, None to hang up
+        self.streaming = True  # False to refuse stream connections
+
+        self.posts: list[tuple[float, dict]] = []  # monotonic time, status posted by the bot
+        self.calls: collections.Counter[str] = collections.Counter()
+        self.uploaded_bytes = 0
+        self.served_bytes = 0
+
+    def next_id(self) -> str:
+        return str(next(self.ids))
+
+    def account(self, acct: str) -> dict:
+        username = acct.split('@')[0]
+        return {
+            'id': str(zlib.crc32(acct.encode())),
+            'username': username,
+            'acct': acct,
+            'display_name': username,
+            'url': f'https://{self.domain}/@{acct}',
+            'created_at': now_iso(),
+        }
+
+    def status(self, account: dict, content: str, visibility: str, in_reply_to_id: str | None,
+               media_attachments: list[dict]) -> dict:
+        status_id = self.next_id()
+        return {
+            'id': status_id,
+            'uri': f'https://{self.domain}/statuses/{status_id}',
+            'url': f'https://{self.domain}/@{account["acct"]}/{status_id}',
+            'created_at': now_iso(),
+            'account': account,
+            'content': content,
+            'visibility': visibility,
+            'in_reply_to_id': in_reply_to_id,
+            'media_attachments': media_attachments,
+            'mentions': [],
+            'tags': [],
+            'emojis': [],
+        }
+
+    def add_file(self, name: str, body: bytes, content_type: str):
+        self.files[name] = (body, content_type)
+
+    def add_mention(self, acct: str, content: str, files: Sequence[str] = (), in_reply_to_id: str | None = None,
+                    visibility: str = 'public') -> dict:
+        """A status from acct mentioning the bot, with entry images from self.files"""
+        with self.lock:
+            attachments: list[dict] = [
+                {
+                    'id': self.next_id(),
+                    'type': 'image',
+                    'url': f'{self.base_url}files/{name}',
+                    'preview_url': f'{self.base_url}files/{name}',
+                    'remote_url': None,
+                    'meta': {},
+                    'description': None,
+                    'blurhash': None,
+                }
+                for name in files
+            ]
+            status = self.status(self.account(acct), content, visibility, in_reply_to_id, attachments)
+            self.statuses[status['id']] = status
+            notification = {
+                'id': self.next_id(),
+                'type': 'mention',
+                'created_at': status['created_at'],
+                'account': status['account'],
+                'status': status,
+            }
+            self.notifications.append(notification)
+            for events in self.streams:
+                events.put(notification)
+            return notification
+
+    def open_stream(self) -> queue.Queue[dict | None] | None:
+        """Events for a new stream connection, or None while streaming is down"""
+        with self.lock:
+            if not self.streaming:
+                return None
+            events: queue.Queue[dict | None] = queue.Queue()
+            self.streams.append(events)
+            return events
+
+    def close_stream(self, events: queue.Queue[dict | None]):
+        with self.lock:
+            self.streams.remove(events)
+
+    def stop_streaming(self):
+        """Hang up every stream and refuse new ones; mentions meanwhile are only in the notifications"""
+        with self.lock:
+            self.streaming = False
+            for events in self.streams:
+                events.put(None)
+
+    def start_streaming(self):
+        with self.lock:
+            self.streaming = True
+
+    def stream_count(self) -> int:
+        with self.lock:
+            return len(self.streams)
+
+    def list_notifications(self, query: dict[str, list[str]]) -> list[dict]:
+        limit = min(int(query.get('limit', ['40'])[0]), 80)
+        types = query.get('types[]') or query.get('types')
+        with self.lock:
+            notifications = [n for n in self.notifications if not types or n['type'] in types]
+
+        if max_id := query.get('max_id', [None])[0]:
+            notifications = [n for n in notifications if int(n['id']) < int(max_id)]
+        if since_id := query.get('since_id', [None])[0]:
+            notifications = [n for n in notifications if int(n['id']) > int(since_id)]
+        if min_id := query.get('min_id', [None])[0]:
+            # The page right after min_id
+            notifications = [n for n in notifications if int(n['id']) > int(min_id)][:limit]
+        else:
+            notifications = notifications[-limit:]
+        return list(reversed(notifications))
+
+    def post_status(self, params: dict) -> dict:
+        media_ids = params.get('media_ids') or []
+        with self.lock:
+            attachments = [self.media[media_id][0] for media_id in media_ids]
+            status = self.status(
+                self.bot, params.get('status', ''), params.get('visibility', 'public'),
+                params.get('in_reply_to_id'), attachments)
+            self.statuses[status['id']] = status
+            self.posts.append((time.monotonic(), status))
+        return status
+
+    def post_media(self, size: int) -> dict:
+        with self.lock:
+            media_id = self.next_id()
+            attachment: dict = {
+                'id': media_id,
+                'type': 'image',
+                'url': f'{self.base_url}media/{media_id}',
+                'preview_url': f'{self.base_url}media/{media_id}',
+                'remote_url': None,
+                'meta': {},
+                'description': None,
+                'blurhash': None,
+            }
+            self.media[media_id] = (attachment, time.monotonic() + self.processing_delay)
+            self.uploaded_bytes += size
+        return self.get_media(media_id)[1]
+
+    def get_media(self, media_id: str) -> tuple[int, dict]:
+        with self.lock:
+            attachment, ready_at = self.media[media_id]
+        if time.monotonic() < ready_at:
+            return 206, {**attachment, 'url': None}
+        return 200, attachment
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'calls': dict(self.calls),
+                'posts': len(self.posts),
+                'uploaded_bytes': self.uploaded_bytes,
+                'served_bytes': self.served_bytes,
+            }
+
+    def instance(self) -> dict:
+        return {
+            'uri': self.domain,
+            'domain': self.domain,
+            'title': 'Fake Mastodon',
+            'version': VERSION,
+            'api_versions': {'mastodon': 2},
+            'description': '',
+        }
+
+
+def now_iso() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # method, path pattern, handler, name the call is counted under (None for the driver's routes)
+    ROUTES = [
+        ('GET', re.compile(r'^/api/v[12]/instance/?$'), 'get_instance', 'GET /api/v*/instance'),
+        ('GET', re.compile(r'^/api/v1/accounts/verify_credentials/?$'), 'get_credentials',
+         'GET /api/v1/accounts/verify_credentials'),
+        ('GET', re.compile(r'^/api/v1/notifications/?$'), 'get_notifications', 'GET /api/v1/notifications'),
+        ('GET', re.compile(r'^/api/v1/streaming/user/?$'), 'get_stream', 'GET /api/v1/streaming/user'),
+        ('POST', re.compile(r'^/api/v1/statuses/?$'), 'post_status', 'POST /api/v1/statuses'),
+        ('GET', re.compile(r'^/api/v1/statuses/(?P<object_id>\d+)/?$'), 'get_status', 'GET /api/v1/statuses/:id'),
+        ('POST', re.compile(r'^/api/v[12]/media/?$'), 'post_media', 'POST /api/v*/media'),
+        ('GET', re.compile(r'^/api/v1/media/(?P<object_id>\d+)/?$'), 'get_media', 'GET /api/v1/media/:id'),
+        ('GET', re.compile(r'^/files/(?P<name>[^/]+)$'), 'get_file', 'GET /files/:name'),
+        ('POST', re.compile(r'^/_fake/files/(?P<name>[^/]+)$'), 'fake_file', None),
+        ('POST', re.compile(r'^/_fake/mentions$'), 'fake_mention', None),
+        ('GET', re.compile(r'^/_fake/stats$'), 'fake_stats', None),
+    ]
+
+    def __init__(self, instance: FakeInstance, *args, **kwargs):
+        self.instance = instance
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method: str):
+        url = urlparse(self.path)
+        for route_method, pattern, handler, name in self.ROUTES:
+            if route_method == method and (matched := pattern.match(url.path)):
+                if name:
+                    with self.instance.lock:
+                        self.instance.calls[name] += 1
+                getattr(self, handler)(parse_qs(url.query), **matched.groupdict())
+                return
+
+        self.read_body()
+        self.send_json(404, {'error': f'Not implemented: {method} {url.path}'})
+
+    def get_instance(self, query):
+        self.send_json(200, self.instance.instance())
+
+    def get_credentials(self, query):
+        self.send_json(200, self.instance.bot)
+
+    def get_notifications(self, query):
+        self.send_json(200, self.instance.list_notifications(query))
+
+    def get_stream(self, query):
+        if (events := self.instance.open_stream()) is None:
+            self.send_json(503, {'error': 'Streaming is down'})
+            return
+
+        # Server-sent events until the instance hangs up or the client goes away
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        try:
+            while True:
+                try:
+                    notification = events.get(timeout=HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    self.wfile.write(b':)\n')
+                    continue
+                if notification is None:
+                    break
+                self.wfile.write(f'event: notification\ndata: {json.dumps(notification)}\n\n'.encode())
+        finally:
+            self.instance.close_stream(events)
+
+    def post_status(self, query):
+        self.send_json(200, self.instance.post_status(self.read_params()))
+
+    def get_status(self, query, object_id):
+        if status := self.instance.statuses.get(object_id):
+            self.send_json(200, status)
+        else:
+            self.send_json(404, {'error': 'Record not found'})
+
+    def post_media(self, query):
+        self.send_json(202, self.instance.post_media(len(self.read_body())))
+
+    def get_media(self, query, object_id):
+        if object_id not in self.instance.media:
+            self.send_json(404, {'error': 'Record not found'})
+            return
+        self.send_json(*self.instance.get_media(object_id))
+
+    def get_file(self, query, name):
+        if name not in self.instance.files:
+            self.send_json(404, {'error': 'Record not found'})
+            return
+
+        body, content_type = self.instance.files[name]
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.instance.lock:
+            self.instance.served_bytes += len(body)
+
+    def fake_file(self, query, name):
+        self.instance.add_file(name, self.read_body(), self.headers.get('Content-Type', 'application/octet-stream'))
+        self.send_json(200, {})
+
+    def fake_mention(self, query):
+        self.send_json(200, self.instance.add_mention(**json.loads(self.read_body())))
+
+    def fake_stats(self, query):
+        self.send_json(200, self.instance.stats())
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def read_params(self) -> dict:
+        """Form, JSON or multipart parameters; lists are keyed without the []"""
+        body = self.read_body()
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            pairs = [(collapse_rfc2231_value(part.get_param('name', '', header='content-disposition')),
+                      part.get_content())
+                     for part in message.iter_parts()]
+        else:
+            pairs = [(key, value) for key, values in parse_qs(body.decode()).items() for value in values]
+
+        params: dict = {}
+        for key, value in pairs:
+            if key.endswith('[]'):
+                params.setdefault(key[:-2], []).append(value)
+            else:
+                params[key] = value
+        return params
+
+    def send_json(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHTTPServer(http.server.ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # The bot stops reading a GIF after its first frame and drops the connection
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeServer:
+    """Serve a FakeInstance on a free local port in a background thread"""
+
+    def __init__(self, instance: FakeInstance):
+        self.instance = instance
+        self.server = QuietHTTPServer(('127.0.0.1', 0), functools.partial(FakeHandler, instance))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        instance.base_url = self.base_url
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    def __enter__(self) -> 'FakeServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeProcess:
+    """Serve a FakeInstance from a child process, driven over its /_fake/ routes"""
+
+    def __init__(self, bot_acct: str = 'picrew', processing_delay: float = 0.0):
+        self.args = [sys.executable, __file__, '--bot-acct', bot_acct, '--processing-delay', str(processing_delay)]
+        self.base_url = ''
+
+    def __enter__(self) -> 'FakeProcess':
+        self.process = subprocess.Popen(self.args, stdout=subprocess.PIPE, text=True)
+        assert self.process.stdout is not None
+        self.base_url = self.process.stdout.readline().strip()
+        if not self.base_url:
+            raise RuntimeError(f'Fake server exited with {self.process.wait()}')
+        self.client = httpx.Client(base_url=self.base_url)
+        return self
+
+    def __exit__(self, *exc):
+        self.client.close()
+        self.process.terminate()
+        self.process.wait()
+
+    def add_file(self, name: str, body: bytes, content_type: str):
+        self.client.post(f'_fake/files/{name}', content=body, headers={'Content-Type': content_type}).raise_for_status()
+
+    def add_mention(self, acct: str, content: str, files: Sequence[str] = (), in_reply_to_id: str | None = None,
+                    visibility: str = 'public') -> dict:
+        response = self.client.post('_fake/mentions', json={
+            'acct': acct,
+            'content': content,
+            'files': list(files),
+            'in_reply_to_id': in_reply_to_id,
+            'visibility': visibility,
+        })
+        response.raise_for_status()
+        return response.json()
+
+    def stats(self) -> dict:
+        response = self.client.get('_fake/stats')
+        response.raise_for_status()
+        return response.json()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Mastodon until killed')
+    parser.add_argument('--bot-acct', default='picrew')
+    parser.add_argument('--processing-delay', type=float, default=0.0, help='seconds media stays processing')
+    args = parser.parse_args()
+
+    instance = FakeInstance(bot_acct=args.bot_acct, processing_delay=args.processing_delay)
+    with FakeServer(instance) as server:
+        print(server.base_url, flush=True)
+        server.thread.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Benchmark drawer.generate_images end to end on synthetic entries
+
+Usage:
+    python benchmarks/generate.py                          # run every case
+    python benchmarks/generate.py --save benchmarks/baseline.json     # and record the results
+    python benchmarks/generate.py --check benchmarks/baseline.json    # and fail on regressions
+
+Entries are MediaAttachments served by a local HTTP server from images
+generated in memory, in several modes (RGBA and palette PNG, JPEG,
+animated GIF and WebP) and sizes. Every case runs in its own subprocess
+with an empty tile cache, so downloads, decoding, rendering and encoding
+are all measured, and ru_maxrss is not polluted by the previous case.
+
+Reported per case: wall time, peak RSS growth, bytes downloaded (as read
+by the client, so a download abandoned early counts only what was read)
+and the size of the encoded question and answer images. Timings depend on the
+machine, so record a baseline on the machine that checks against it.
+"""
+import argparse
+import functools
+import http.server
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# As in picrew_bot.bot, which is not imported here so no state directory is created
+MIN_ENTRY = 2
+MAX_ENTRY = 30
+
+# name: (modes, image size, entry count)
+CASES = {
+    'rgba-small-2': (['RGBA'], 400, MIN_ENTRY),
+    'mixed-small-10': (['RGBA', 'P', 'JPEG', 'GIF', 'WEBP'], 400, 10),
+    'mixed-small-30': (['RGBA', 'P', 'JPEG', 'GIF', 'WEBP'], 400, MAX_ENTRY),
+    'jpeg-large-10': (['JPEG'], 2400, 10),
+    'rgba-large-10': (['RGBA'], 2400, 10),
+    'gif-large-10': (['GIF'], 1200, 10),
+    'webp-large-10': (['WEBP'], 1200, 10),
+    'mixed-large-30': (['RGBA', 'P', 'JPEG', 'GIF', 'WEBP'], 1600, MAX_ENTRY),
+}
+
+# How much worse than the baseline a result may be before --check fails
+TOLERANCES = {
+    'seconds': 1.25,
+    'peak_rss_mib': 1.5,  # thread timing makes this noisy
+    'downloaded_bytes': 1.0,
+    'output_bytes': 1.10,
+}
+
+ANIMATION_FRAMES = 8
+
+
+def synthetic_image(mode: str, size: int, seed: int) -> tuple[bytes, str]:
+    """An encoded image with some detail, so decoders and encoders do real work"""
+    from PIL import Image, ImageDraw
+
+    def frame(shift: int) -> Image.Image:
+        image = Image.new('RGBA', (size, size), (seed * 37 % 256, 96, 160, 255))
+        draw = ImageDraw.Draw(image)
+        for i in range(0, size // 2, max(size // 32, 1)):
+            color = ((i + shift) % 256, (seed * 11 + i) % 256, (i * 3) % 256, 160)
+            draw.ellipse((i, i // 2, size - 1 - i, size - 1 - i // 2), outline=color, width=max(size // 100, 1))
+        return image
+
+    buffer = io.BytesIO()
+    if mode == 'RGBA':
+        frame(0).save(buffer, 'PNG')
+        return buffer.getvalue(), 'image/png'
+    if mode == 'P':
+        frame(0).convert('RGB').quantize(64).save(buffer, 'PNG')
+        return buffer.getvalue(), 'image/png'
+    if mode == 'JPEG':
+        frame(0).convert('RGB').save(buffer, 'JPEG', quality=90)
+        return buffer.getvalue(), 'image/jpeg'
+
+    frames = [frame(shift * 16) for shift in range(ANIMATION_FRAMES)]
+    if mode == 'GIF':
+        frames = [image.convert('RGB').quantize(64) for image in frames]
+        frames[0].save(buffer, 'GIF', save_all=True, append_images=frames[1:], duration=80, loop=0)
+        return buffer.getvalue(), 'image/gif'
+    if mode == 'WEBP':
+        frames[0].save(buffer, 'WEBP', save_all=True, append_images=frames[1:], duration=80, loop=0)
+        return buffer.getvalue(), 'image/webp'
+    raise ValueError(f'Unknown mode: {mode}')
+
+
+class ImageServer:
+    """Serve in-memory images over HTTP"""
+
+    def __init__(self, images: dict[str, tuple[bytes, str]]):
+        self.images = images
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(ImageHandler, self))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    def __enter__(self) -> 'ImageServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+
+    def __init__(self, image_server: ImageServer, *args, **kwargs):
+        self.image_server = image_server
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        image = self.image_server.images.get(self.path.lstrip('/'))
+        if image is None:
+            self.send_error(404)
+            return
+
+        body, content_type = image
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReadCounter:
+    """Bytes read by every client created through create_client"""
+
+    def __init__(self):
+        self.read_bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, size: int):
+        with self.lock:
+            self.read_bytes += size
+
+    def create_client(self) -> httpx.Client:
+        """A client like drawer.create_client's, counting the response bodies it reads"""
+        from picrew_bot import drawer
+
+        limits = httpx.Limits(
+            max_connections=drawer.DOWNLOAD_CONCURRENCY, max_keepalive_connections=drawer.DOWNLOAD_CONCURRENCY)
+        return httpx.Client(
+            timeout=drawer.DOWNLOAD_TIMEOUT, transport=CountingTransport(httpx.HTTPTransport(limits=limits), self))
+
+
+class CountingTransport(httpx.BaseTransport):
+
+    def __init__(self, transport: httpx.BaseTransport, counter: ReadCounter):
+        self.transport = transport
+        self.counter = counter
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = self.transport.handle_request(request)
+        response.stream = CountingStream(response.stream, self.counter)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+class CountingStream(httpx.SyncByteStream):
+
+    def __init__(self, stream, counter: ReadCounter):
+        self.stream = stream
+        self.counter = counter
+
+    def __iter__(self):
+        for chunk in self.stream:
+            self.counter.count(len(chunk))
+            yield chunk
+
+    def close(self):
+        self.stream.close()
+
+
+def run_case(name: str) -> dict:
+    modes, size, count = CASES[name]
+
+    # Keep the tile cache of this run away from the bot's
+    os.environ['PICREW_STORAGE_PATH'] = tempfile.mkdtemp(prefix='picrew-bench-')
+
+    from mastodon.return_types import MediaAttachment
+
+    from picrew_bot import drawer
+
+    # Every client the drawer creates counts what it reads
+    counter = ReadCounter()
+    drawer.create_client = counter.create_client
+
+    images = {}
+    for i in range(count):
+        mode = modes[i % len(modes)]
+        images[f'{i}-{mode.lower()}'] = synthetic_image(mode, size, i)
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with ImageServer(images) as server:
+        attachments = [
+            (f'user{i}@example.com',
+             MediaAttachment(id=str(i), type='image', url=server.base_url + path, remote_url=None,
+                             preview_url=server.base_url + path, meta={}))
+            for i, path in enumerate(images)
+        ]
+
+        started = time.perf_counter()
+        questions, answers = drawer.generate_images(attachments)
+        seconds = time.perf_counter() - started
+        downloaded_bytes = counter.read_bytes
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'seconds': round(seconds, 3),
+        'peak_rss_mib': round((peak_rss - baseline_rss) / 1024, 1),
+        'downloaded_bytes': downloaded_bytes,
+        'output_bytes': sum(map(len, questions)) + sum(map(len, answers)),
+    }
+
+
+def check(results: dict[str, dict], baseline: dict[str, dict]) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, tolerance in TOLERANCES.items():
+            limit = baseline[name][metric] * tolerance
+            if result[metric] > limit:
+                regressions.append(f'{name}: {metric} {result[metric]} > {limit:g} (baseline {baseline[name][metric]})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark drawer.generate_images')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--only', nargs='+', choices=CASES, help='run only these cases')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE')
+    parser.add_argument('--check', metavar='FILE', help='fail if a result is worse than FILE')
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case)))
+        return
+
+    results = {}
+    for name in args.only or CASES:
+        output = subprocess.run(
+            [sys.executable, __file__, '--case', name], check=True, capture_output=True, text=True).stdout
+        results[name] = json.loads(output.splitlines()[-1])
+        result = results[name]
+        print(f'{name:>16}: {result["seconds"]:6.2f}s, +{result["peak_rss_mib"]:7.1f} MiB peak RSS, '
+              f'{result["downloaded_bytes"] / 1024:8.0f} KiB in, {result["output_bytes"] / 1024:6.0f} KiB out')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        if regressions := check(results, baseline):
+            print('\n'.join(['Regressions:', *regressions]))
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
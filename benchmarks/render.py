@@ -0,0 +1,109 @@
+"""Compare peak memory and wall time of the canvas renderer
+
+Usage: python benchmarks/render.py
+
+Every case runs in its own subprocess so ru_maxrss is not polluted by the
+previous one. Tiles are generated in memory; nothing is downloaded.
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+COUNTS = [2, 10, 30]
+
+
+def synthetic_tiles(count: int):
+    from PIL import Image
+
+    from picrew_bot import drawer
+
+    return [
+        (f'user{i}@example.com',
+         drawer.make_tile(Image.new('RGBA', (drawer.CELL_SIZE, drawer.CELL_SIZE), (i * 8 % 256, 64, 128, 200))))
+        for i in range(count)
+    ]
+
+
+def legacy_render(entries, question_path: str, answer_path: str):
+    """The two-canvas RGBA renderer this replaced, kept for comparison"""
+    import math
+
+    from PIL import Image, ImageDraw, ImageFont
+
+    from picrew_bot.drawer import (CELL_GAP, CELL_SIZE, FONT_BACKGROUND, FONT_COLOR, FONT_GAP, FONT_PATH,
+                                   NAME_POSITION, NUMBER_FONT_SIZE)
+
+    ANSWER_FONT_SIZE = CELL_SIZE // 20
+
+    count = len(entries)
+    cols = math.ceil(count ** 0.5)
+    rows = math.ceil(count / cols)
+
+    canvas_width = cols * (CELL_SIZE + CELL_GAP) + CELL_GAP
+    canvas_height = rows * (CELL_SIZE + CELL_GAP) + CELL_GAP
+
+    question_canvas = Image.new('RGBA', (canvas_width, canvas_height), 'white')
+    answer_canvas = question_canvas.copy()
+    question_draw = ImageDraw.Draw(question_canvas)
+    answer_draw = ImageDraw.Draw(answer_canvas)
+    answer_font = ImageFont.truetype(FONT_PATH, ANSWER_FONT_SIZE)
+    number_font = ImageFont.truetype(FONT_PATH, NUMBER_FONT_SIZE)
+
+    for i, (acct, image) in enumerate(entries):
+        x = i % cols * (CELL_SIZE + CELL_GAP) + CELL_GAP
+        y = i // cols * (CELL_SIZE + CELL_GAP) + CELL_GAP
+        image = image.convert('RGBA')
+        question_canvas.paste(image, (x, y), image)
+        answer_canvas.paste(image, (x, y), image)
+        number_xy = (x + CELL_SIZE / 2, y - CELL_GAP / 2)
+        question_draw.text(number_xy, f'{i + 1:d}', font=number_font, anchor='mm', fill=FONT_COLOR)
+        answer_draw.text(number_xy, f'{i + 1:d}', font=number_font, anchor='mm', fill=FONT_COLOR)
+        name_xy = (x + CELL_SIZE * NAME_POSITION[0], y + CELL_SIZE * NAME_POSITION[1])
+        left, top, right, bottom = answer_draw.textbbox(name_xy, acct, font=answer_font, anchor='mm')
+        answer_draw.rectangle((left - FONT_GAP, top - FONT_GAP, right + FONT_GAP, bottom + FONT_GAP),
+                              fill=FONT_BACKGROUND, outline=FONT_COLOR, width=2)
+        answer_draw.text(name_xy, acct, font=answer_font, anchor='mm', fill=FONT_COLOR)
+
+    question_canvas.convert('RGB').save(question_path)
+    answer_canvas.convert('RGB').save(answer_path)
+
+
+def current_render(entries, question_path: str, answer_path: str):
+    from picrew_bot import drawer
+
+    questions, answers = drawer.render_to_bytes(entries)
+    drawer.save_images(questions, [f'{question_path}.{page}' for page in range(len(questions))])
+    drawer.save_images(answers, [f'{answer_path}.{page}' for page in range(len(answers))])
+
+
+def run_case(impl: str, count: int):
+    entries = synthetic_tiles(count)
+    render = legacy_render if impl == 'legacy' else current_render
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        started = time.perf_counter()
+        render(entries, os.path.join(tmpdir, 'q.webp'), os.path.join(tmpdir, 'a.webp'))
+        elapsed = time.perf_counter() - started
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'{impl:>8} {count:>3} entries: {elapsed:6.2f}s, +{(peak_rss - baseline_rss) / 1024:7.1f} MiB peak RSS')
+
+
+def main():
+    if len(sys.argv) == 3:
+        run_case(sys.argv[1], int(sys.argv[2]))
+        return
+
+    for count in COUNTS:
+        for impl in ['legacy', 'current']:
+            subprocess.run([sys.executable, __file__, impl, str(count)], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Replay festival requests and entries through Bot against a fake Mastodon
+
+Usage:
+    python benchmarks/replay.py [options]                    # generated scenario
+    python benchmarks/replay.py --save-scenario burst.json --burst
+    python benchmarks/replay.py --scenario burst.json        # replay a recorded one
+
+A scenario lists festival requests and the entries replying to each, with
+times in seconds: requests from the start of the replay, entries from the
+moment the bot opens their festival. The driver injects them into the
+fake server (benchmarks/fakemastodon.py), which runs in a process of its
+own so it does not slow the bot down, and drives the bot with do_job
+like Bot.run does, polling every --poll seconds. Festival schedules are
+compressed to --prepare-seconds, --reveal-seconds and --answer-seconds so
+a replay takes seconds rather than an hour.
+
+Reported: how late every phase was posted against its schedule, time spent
+in the main Bot methods, API calls per endpoint, and bytes moved.
+"""
+import argparse
+import collections
+import datetime
+import functools
+import heapq
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from fakemastodon import FakeProcess
+from generate import synthetic_image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+IMAGE_KINDS = ['RGBA', 'P', 'JPEG', 'GIF', 'WEBP']
+IMAGE_SIZE = 800
+BOT_ACCT = 'picrew'
+
+# Bot methods whose time is reported
+TIMED_METHODS = [
+    'do_job',
+    'check_notifications',
+    'close_entries',
+    'render_images',
+    'post_media',
+    'wait_for_media',
+    'publish_question',
+    'reveal_entries',
+    'prepare_answer_media',
+    'reveal_answer',
+]
+
+
+def generate_scenario(args) -> dict:
+    rng = random.Random(args.seed)
+    festivals = []
+    for index in range(args.festivals):
+        entries = []
+        for i in range(args.entrants):
+            if args.burst:
+                at = args.prepare_seconds / 2
+            else:
+                at = rng.uniform(0, args.prepare_seconds * 0.8)
+            images = [rng.choice(IMAGE_KINDS) for _ in range(rng.choice([1, 1, 1, 2]))]
+            entries.append({'at': round(at, 3), 'acct': f'entrant{i}@remote{i % 7}.example', 'images': images})
+
+        for i in range(args.late_entrants):
+            # These arrive after the festival closed
+            entries.append({'at': args.prepare_seconds + 1, 'acct': f'late{i}@remote.example', 'images': ['JPEG']})
+
+        festivals.append({
+            'at': index * args.stagger,
+            'requester': f'host{index}@remote.example',
+            'content': (
+                f'<p>@{BOT_ACCT} <a href="https://picrew.me/image_maker/{index}">'
+                f'https://picrew.me/image_maker/{index}</a><br>Festival {index}</p>'),
+            'entries': sorted(entries, key=lambda entry: entry['at']),
+        })
+    return {'festivals': festivals}
+
+
+class Recorder:
+    """Time Bot methods and collect phase lateness"""
+
+    def __init__(self, bot):
+        self.timings: dict[str, list[float]] = collections.defaultdict(list)
+        self.lateness: dict[str, list[float]] = collections.defaultdict(list)
+
+        for name in TIMED_METHODS:
+            setattr(bot, name, self.timed(name, getattr(bot, name)))
+
+        log_lateness = bot.log_lateness
+
+        @functools.wraps(log_lateness)
+        def record_lateness(phase: str, scheduled: datetime.datetime):
+            lateness = datetime.datetime.now().astimezone() - scheduled
+            self.lateness[phase].append(lateness.total_seconds())
+            log_lateness(phase, scheduled)
+
+        bot.log_lateness = record_lateness
+
+    def timed(self, name: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.timings[name].append(time.perf_counter() - started)
+        return wrapper
+
+
+def replay(scenario: dict, args) -> dict:
+    # Keep the state and tile cache of this run away from the bot's
+    os.environ['PICREW_STORAGE_PATH'] = tempfile.mkdtemp(prefix='picrew-replay-')
+
+    from picrew_bot import bot as bot_module
+
+    with FakeProcess(bot_acct=BOT_ACCT, processing_delay=args.processing_delay) as instance:
+        for i, kind in enumerate(IMAGE_KINDS):
+            instance.add_file(kind.lower(), *synthetic_image(kind, IMAGE_SIZE, i))
+
+        bot = bot_module.Bot(instance.base_url.rstrip('/'), 'token')
+        recorder = Recorder(bot)
+
+        requests = sorted(enumerate(scenario['festivals']), key=lambda item: item[1]['at'])
+        request_indexes: dict[str, int] = {}  # request notification id: festival index
+        opened: set[int] = set()
+        entries: list[tuple[float, int, int, str]] = []  # due, entry order, festival index, prepare status id
+
+        started = time.monotonic()
+        deadline = started + args.timeout
+        next_poll = started
+        while True:
+            now = time.monotonic()
+
+            while requests and started + requests[0][1]['at'] <= now:
+                index, festival = requests.pop(0)
+                notification = instance.add_mention(festival['requester'], festival['content'])
+                request_indexes[notification['id']] = index
+
+            while entries and entries[0][0] <= now:
+                _, entry_order, index, prepare_status_id = heapq.heappop(entries)
+                entry = scenario['festivals'][index]['entries'][entry_order]
+                instance.add_mention(
+                    entry['acct'], f'<p>@{BOT_ACCT}</p>',
+                    [kind.lower() for kind in entry['images']],
+                    in_reply_to_id=prepare_status_id)
+
+            if now >= next_poll:
+                bot.do_job()
+                next_poll = time.monotonic() + args.poll
+            else:
+                bot.check_festival()
+                bot.save()
+
+            for festival in bot.festivals.values():
+                opened_index = request_indexes.get(str(festival.request_noti_id))
+                if opened_index is None or opened_index in opened:
+                    continue
+                opened.add(opened_index)
+
+                # Compress the schedule, counting from now
+                opened_at = datetime.datetime.now().astimezone()
+                festival.prepare_end = opened_at + datetime.timedelta(seconds=args.prepare_seconds)
+                festival.name_reveal_at = festival.prepare_end + datetime.timedelta(seconds=args.reveal_seconds)
+                festival.answer_reveal_at = festival.name_reveal_at + datetime.timedelta(seconds=args.answer_seconds)
+                for entry_order, entry in enumerate(scenario['festivals'][opened_index]['entries']):
+                    heapq.heappush(entries, (
+                        time.monotonic() + entry['at'], entry_order, opened_index, str(festival.prepare_status_id)))
+
+            if not requests and not entries and not bot.festivals:
+                break
+            if time.monotonic() > deadline:
+                print(f'Timed out with {len(bot.festivals)} festivals running', file=sys.stderr)
+                break
+
+            wakeups = [next_poll, time.monotonic() + bot.seconds_until_wakeup(args.poll)]
+            if requests:
+                wakeups.append(started + requests[0][1]['at'])
+            if entries:
+                wakeups.append(entries[0][0])
+            time.sleep(max(min(wakeups) - time.monotonic(), 0))
+
+        elapsed = time.monotonic() - started
+        bot.render_pool.shutdown()
+        stats = instance.stats()
+
+    return {
+        'seconds': round(elapsed, 3),
+        'festivals': len(scenario['festivals']),
+        'entries': sum(len(festival['entries']) for festival in scenario['festivals']),
+        'posts': stats['posts'],
+        'lateness': {phase: summary(values) for phase, values in recorder.lateness.items()},
+        'timings': {name: summary(values) for name, values in recorder.timings.items()},
+        'calls': dict(collections.Counter(stats['calls']).most_common()),
+        'served_bytes': stats['served_bytes'],
+        'uploaded_bytes': stats['uploaded_bytes'],
+    }
+
+
+def summary(values: list[float]) -> dict:
+    return {
+        'count': len(values),
+        'mean': round(statistics.fmean(values), 4),
+        'p50': round(statistics.median(values), 4),
+        'max': round(max(values), 4),
+    }
+
+
+def print_report(report: dict):
+    print(f'{report["festivals"]} festivals, {report["entries"]} entries, {report["posts"]} posts '
+          f'in {report["seconds"]:.1f}s')
+    print(f'{report["served_bytes"] / 1024:.0f} KiB of entries downloaded, '
+          f'{report["uploaded_bytes"] / 1024:.0f} KiB of media uploaded')
+
+    print('\nLateness against schedule (s):')
+    for phase, stats in report['lateness'].items():
+        print(f'  {phase:>20}: n={stats["count"]:<4} mean {stats["mean"]:+8.3f}  p50 {stats["p50"]:+8.3f}  '
+              f'max {stats["max"]:+8.3f}')
+
+    print('\nTime in Bot methods (s):')
+    for name, stats in report['timings'].items():
+        print(f'  {name:>20}: n={stats["count"]:<4} mean {stats["mean"]:8.3f}  p50 {stats["p50"]:8.3f}  '
+              f'max {stats["max"]:8.3f}')
+
+    print('\nAPI calls:')
+    for endpoint, count in report['calls'].items():
+        print(f'  {endpoint:>40}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay festivals through Bot against a fake Mastodon')
+    parser.add_argument('--scenario', metavar='FILE', help='replay a recorded scenario instead of generating one')
+    parser.add_argument('--save-scenario', metavar='FILE', help='write the scenario to FILE')
+    parser.add_argument('--json', metavar='FILE', help='write the report to FILE')
+
+    generated = parser.add_argument_group('generated scenario')
+    generated.add_argument('--festivals', type=int, default=3)
+    generated.add_argument('--entrants', type=int, default=30)
+    generated.add_argument('--late-entrants', type=int, default=2)
+    generated.add_argument('--burst', action='store_true', help='all entries of a festival arrive at once')
+    generated.add_argument('--stagger', type=float, default=1.0, help='seconds between festival requests')
+    generated.add_argument('--seed', type=int, default=0)
+
+    timing = parser.add_argument_group('timing')
+    timing.add_argument('--prepare-seconds', type=float, default=10.0)
+    timing.add_argument('--reveal-seconds', type=float, default=3.0)
+    timing.add_argument('--answer-seconds', type=float, default=3.0)
+    timing.add_argument('--processing-delay', type=float, default=1.0, help='seconds media stays processing')
+    timing.add_argument('--poll', type=float, default=1.0, help='seconds between do_job calls')
+    timing.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+
+    if args.scenario:
+        with open(args.scenario) as f:
+            scenario = json.load(f)
+    else:
+        scenario = generate_scenario(args)
+
+    if args.save_scenario:
+        with open(args.save_scenario, 'w') as f:
+            json.dump(scenario, f, indent=2)
+            f.write('\n')
+
+    report = replay(scenario, args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Check content.parse_request against the regex pipeline it replaced, and time both
+
+Usage: python benchmarks/request.py [requests] [seed]
+
+Requests are built at random from directive lines, near misses (no value,
+a leading space, \\r endings), URL directives, the picrew link and the
+bot's mention mid-line, plus a few fixed edge cases. Every one must give
+the same schedule and description as before; the exit status is 1 if
+any does not.
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from picrew_bot.content import parse_request  # noqa: E402
+
+LINK = 'https://picrew.me/image_maker/1234'
+MENTION = '@picrew'
+
+RE_PREPARE = re.compile(r'^마감: (?P<time>.+)$', re.M)
+RE_NAME_REVEAL = re.compile(r'^참가자 공개: (?P<time>.+)$', re.M)
+RE_ANSWER_REVEAL = re.compile(r'^정답 공개: (?P<time>.+)$', re.M)
+RE_ALLOW_MULTI = re.compile(r'^다중참가$', re.M)
+RE_URL = re.compile(r'(?:URL|주소): (.+)$', re.M)
+
+PIECES = [
+    '마감: ', '마감: 30분', '마감: 12:00', '참가자 공개: ', '참가자 공개: 즉시', '정답 공개: 1시간', '정답 공개: 바로',
+    ' 마감: 10분', '마감:10분', '다중참가', ' 다중참가', '다중참가 ', 'URL: ', f'URL: {LINK}', f'주소: {LINK}',
+    'URL: x 주소: y', f'{MENTION} ', LINK, MENTION, '축제 설명', 'hello', ' ', '\r', '\t', ':',
+]
+
+FIXED = [
+    '',
+    f'{MENTION} {LINK}',
+    f'{MENTION} {LINK}\n마감: 30분\n참가자 공개: 10분\n정답 공개: 5분\n다중참가\n설명입니다',
+    f'{MENTION}\nURL: {LINK}\n마감: 30분\r\n설명',
+    f'마감: {LINK}\n{LINK}마감: 10분',
+    f'{MENTION}마감: 10분\n다중{LINK}참가',
+    '마감: 1분\n마감: 2분\n\n\n',
+    'a 주소: URL: \nb URL: ',
+]
+
+
+def typical_request(lines: int) -> str:
+    """A request as people write them: the schedule, then a description"""
+    description = '\n'.join(f'축제 설명 {i}번째 줄, 즐겁게 참가해주세요!' for i in range(lines))
+    return f'{MENTION} {LINK}\n마감: 30분\n참가자 공개: 10분\n정답 공개: 5분\n\n{description}'
+
+
+def legacy(text: str, removed: tuple[str, ...]) -> tuple:
+    def value(pattern):
+        return matched.group('time') if (matched := pattern.search(text)) else None
+
+    description = text
+    for string in removed:
+        description = description.replace(string, '')
+    for pattern in [RE_PREPARE, RE_NAME_REVEAL, RE_ANSWER_REVEAL, RE_ALLOW_MULTI, RE_URL]:
+        description = pattern.sub('', description)
+    return (value(RE_PREPARE), value(RE_NAME_REVEAL), value(RE_ANSWER_REVEAL), bool(RE_ALLOW_MULTI.search(text)),
+            description.strip() or None)
+
+
+def single_pass(text: str, removed: tuple[str, ...]) -> tuple:
+    request = parse_request(text, removed)
+    return (request.prepare_end, request.name_reveal_at, request.answer_reveal_at, request.allow_multi,
+            request.description)
+
+
+def random_request(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(0, 8)):
+        lines.append(''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 3))))
+    return '\n'.join(lines)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    removed = (LINK, MENTION)
+    texts = FIXED + [random_request(rng) for _ in range(count)]
+
+    mismatches = 0
+    for text in texts:
+        if (expected := legacy(text, removed)) != (actual := single_pass(text, removed)):
+            mismatches += 1
+            if mismatches <= 10:
+                print(f'Mismatch for {text!r}:\n  legacy      {expected!r}\n  single pass {actual!r}')
+    print(f'{len(texts)} requests, {mismatches} mismatches')
+
+    corpora = {'random': texts, **{f'{lines} lines': [typical_request(lines)] * 2000 for lines in (0, 3, 10)}}
+    for corpus, requests in corpora.items():
+        for name, parse in [('legacy', legacy), ('single pass', single_pass)]:
+            started = time.perf_counter()
+            for text in requests:
+                parse(text, removed)
+            print(f'{corpus:>8} {name:>11}: {(time.perf_counter() - started) / len(requests) * 1e6:6.2f}us per request')
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
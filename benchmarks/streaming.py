@@ -0,0 +1,116 @@
+"""Check that the streaming loops lose no mention across a stream disconnect
+
+Usage: python benchmarks/streaming.py [--async]
+
+With --async, the bot runs under runner.AsyncRunner instead of Bot.run_streaming.
+
+Against the fake Mastodon (benchmarks/fakemastodon.py), the bot opens a
+festival and streams its entries. The stream is then taken down, one
+entry arrives while it is down, the stream comes back and more entries
+arrive on it. Checked: the entry missed by the stream is backfilled
+before the one that arrived after the reconnect is handled, both are
+collected, the notification cursor follows the streamed mentions, and
+entries after the reconnect are handled from the stream with no polling.
+The exit status is 1 if any check fails.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from fakemastodon import FakeInstance, FakeServer
+from generate import synthetic_image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+BOT_ACCT = 'picrew'
+NOTIFICATIONS = 'GET /api/v1/notifications'
+# The stream reconnects within stream.RECONNECT_SECONDS
+TIMEOUT = 20.0
+
+
+def wait_for(condition, timeout: float = TIMEOUT) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def main():
+    # Keep the state and tile cache of this run away from the bot's
+    os.environ['PICREW_STORAGE_PATH'] = tempfile.mkdtemp(prefix='picrew-streaming-')
+
+    from picrew_bot import bot as bot_module
+    from picrew_bot import runner, stream
+
+    instance = FakeInstance(bot_acct=BOT_ACCT)
+    instance.add_file('entry', *synthetic_image('RGBA', 400, 0))
+    failures: list[str] = []
+
+    def check(ok: bool, message: str):
+        print(f'{"ok" if ok else "FAILED"}: {message}')
+        if not ok:
+            failures.append(message)
+
+    with FakeServer(instance) as server:
+        request = instance.add_mention(
+            'host@remote.example',
+            f'<p>@{BOT_ACCT} <a href="https://picrew.me/image_maker/1">https://picrew.me/image_maker/1</a></p>')
+
+        bot = bot_module.Bot(server.base_url.rstrip('/'), 'token')
+        if '--async' in sys.argv[1:]:
+            stream.STREAMING = True
+            threading.Thread(target=asyncio.run, args=(runner.AsyncRunner(bot).run(),), name='bot', daemon=True).start()
+        else:
+            threading.Thread(target=bot.run_streaming, name='bot', daemon=True).start()
+
+        if not wait_for(lambda: bot.festivals and instance.stream_count()):
+            print('The festival did not open or the stream did not connect', file=sys.stderr)
+            sys.exit(1)
+        festival = next(iter(bot.festivals.values()))
+        check(str(festival.request_noti_id) == request['id'], 'festival opened from the backfill')
+
+        def entry(acct: str) -> dict:
+            return instance.add_mention(
+                acct, f'<p>@{BOT_ACCT}</p>', ['entry'], in_reply_to_id=str(festival.prepare_status_id))
+
+        def collected(acct: str) -> bool:
+            return bot.full_acct(acct) in festival.entries
+
+        first = entry('first@remote.example')
+        check(wait_for(lambda: collected('first@remote.example')), 'entry collected from the stream')
+        check(str(bot.notification_cursor) == first['id'], 'cursor follows the streamed entry')
+        # Let the loop go back to waiting on the stream
+        time.sleep(1)
+
+        instance.stop_streaming()
+        entry('missed@remote.example')
+        time.sleep(1)
+        instance.start_streaming()
+        check(wait_for(lambda: instance.stream_count()), 'stream reconnected')
+
+        polls = instance.calls[NOTIFICATIONS]
+        resumed = entry('resumed@remote.example')
+        check(wait_for(lambda: collected('resumed@remote.example')), 'entry after the reconnect collected')
+        check(collected('missed@remote.example'), 'entry missed by the stream backfilled')
+        check(instance.calls[NOTIFICATIONS] > polls, 'gap backfilled over REST')
+        check(str(bot.notification_cursor) == resumed['id'], 'cursor past the gap')
+
+        polls = instance.calls[NOTIFICATIONS]
+        last = entry('last@remote.example')
+        check(wait_for(lambda: collected('last@remote.example')), 'stream resumed')
+        check(instance.calls[NOTIFICATIONS] == polls, 'no polling once caught up')
+        check(str(bot.notification_cursor) == last['id'], 'cursor follows the resumed stream')
+
+        print(f'{len(festival.entries)} entries collected')
+        bot.render_pool.shutdown()
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
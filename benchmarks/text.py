@@ -0,0 +1,99 @@
+"""Compare laying out labels per render with the cached fonts and sprites
+
+Usage: python benchmarks/text.py [renders]
+
+Draws the numbers and name labels of a full grid on a blank canvas, as
+render_page does, without pasting tiles or encoding. Every render has
+names not seen before, as every festival does, so only the fonts and the
+number sprites carry over between renders. The first render also pays
+for loading fonts.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+COUNTS = [2, 10, 30]
+
+ACCTS = [
+    'user@example.com',
+    '한글사용자@example.com',
+    'emoji_😀✨@example.com',
+    'long_account_name_for_layout@example.social',
+]
+
+
+def accts(count: int, render: int) -> list[str]:
+    """Names for one render, none of them in an earlier one"""
+    return [f'{render}_{i}{ACCTS[i % len(ACCTS)]}' for i in range(count)]
+
+
+def legacy_labels(canvas, names: list[str], layout):
+    """Fonts loaded and every label laid out again on each render"""
+    from PIL import ImageDraw, ImageFont
+
+    from picrew_bot.drawer import (ANSWER_FONT_RATIO, CELL_GAP, FONT_BACKGROUND, FONT_COLOR, FONT_GAP, FONT_PATH,
+                                   NAME_POSITION, NUMBER_FONT_SIZE)
+
+    draw = ImageDraw.Draw(canvas)
+    cell_size = layout.cell_size
+    answer_font = ImageFont.truetype(FONT_PATH, round(cell_size * ANSWER_FONT_RATIO))
+    number_font = ImageFont.truetype(FONT_PATH, NUMBER_FONT_SIZE)
+    for i, acct in enumerate(names):
+        x, y = layout.position(i)
+        draw.text((x + cell_size / 2, y - CELL_GAP / 2), f'{i + 1:d}', font=number_font, anchor='mm', fill=FONT_COLOR)
+        name_xy = (x + cell_size * NAME_POSITION[0], y + cell_size * NAME_POSITION[1])
+        left, top, right, bottom = draw.textbbox(name_xy, acct, font=answer_font, anchor='mm')
+        draw.rectangle((left - FONT_GAP, top - FONT_GAP, right + FONT_GAP, bottom + FONT_GAP),
+                       fill=FONT_BACKGROUND, outline=FONT_COLOR, width=2)
+        draw.text(name_xy, acct, font=answer_font, anchor='mm', fill=FONT_COLOR)
+
+
+def sprite_labels(canvas, names: list[str], layout):
+    from PIL import ImageDraw
+
+    from picrew_bot import fonts
+    from picrew_bot.drawer import (ANSWER_FONT_RATIO, CELL_GAP, FONT_BACKGROUND, FONT_COLOR, FONT_GAP, FONT_PATH,
+                                   NAME_POSITION, NUMBER_FONT_SIZE)
+
+    draw = ImageDraw.Draw(canvas)
+    cell_size = layout.cell_size
+    answer_font_size = round(cell_size * ANSWER_FONT_RATIO)
+    for i, acct in enumerate(names):
+        x, y = layout.position(i)
+        number = fonts.number_sprite(i + 1, FONT_PATH, NUMBER_FONT_SIZE, FONT_COLOR)
+        left, top, _, _ = fonts.centered_box(number, (x + cell_size / 2, y - CELL_GAP / 2))
+        canvas.paste(number, (left, top), number)
+        name = fonts.text_sprite(acct, FONT_PATH, answer_font_size, FONT_COLOR)
+        left, top, right, bottom = fonts.centered_box(
+            name, (x + cell_size * NAME_POSITION[0], y + cell_size * NAME_POSITION[1]))
+        draw.rectangle((left - FONT_GAP, top - FONT_GAP, right + FONT_GAP, bottom + FONT_GAP),
+                       fill=FONT_BACKGROUND, outline=FONT_COLOR, width=2)
+        canvas.paste(name, (left, top), name)
+
+
+def main():
+    from PIL import Image
+
+    from picrew_bot import drawer
+
+    renders = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    for count in COUNTS:
+        layout = drawer.Layout.for_count(count)
+        canvas = Image.new('RGB', layout.canvas_size, 'white')
+        for impl, labels in [('legacy', legacy_labels), ('sprites', sprite_labels)]:
+            started = time.perf_counter()
+            labels(canvas, accts(count, 0), layout)
+            first = time.perf_counter() - started
+
+            names = [accts(count, render) for render in range(1, renders + 1)]
+            started = time.perf_counter()
+            for render_names in names:
+                labels(canvas, render_names, layout)
+            average = (time.perf_counter() - started) / renders
+            print(f'{impl:>8} {count:>3} labels: first {first * 1000:7.2f}ms, then {average * 1000:7.2f}ms per render')
+
+
+if __name__ == '__main__':
+    main()
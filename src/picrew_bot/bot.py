@@ -1,35 +1,53 @@
+import asyncio
 import datetime
 import enum
+import functools
+import io
 import json
 import logging
 import math
+import os
 import re
 import time
 
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from urllib.parse import urlparse
+from typing import IO
 
 import humanize
 import mastodon
 
-from lxml import html
 from mastodon.types_base import IdType
 from mastodon.return_types import MediaAttachment, Notification, Status
 
 from . import common
 from . import drawer
 from . import messages
+from . import metrics
+from . import stream
+from .client import MastodonClient
+from .collector import EntryCollector
+from .content import FestivalRequest, parse_request, parse_status
+from .renderer import RenderPool
+from .store import StateStore
 
 humanize.i18n.activate('ko_KR')
 
-ALLOWED_DOMAINS = [
-    'picrew.me',
-    'www.neka.cc',
-]
 MIN_ENTRY = 2
 MAX_ENTRY = 30
 
 MAX_DURATION = datetime.timedelta(days=1)
+MAX_FESTIVALS = int(os.getenv('PICREW_MAX_FESTIVALS', '3'))
+POLL_SECONDS = 60
+PREFETCH_WAIT_SECONDS = 60
+NOTIFICATION_PAGE_SIZE = 40
+
+# How early slow work starts before its deadline
+PREPARE_AHEAD = datetime.timedelta(seconds=90)
+ANSWER_UPLOAD_AHEAD = datetime.timedelta(seconds=60)
+# Give up on an upload the server has not processed by then
+MEDIA_PROCESSING_TIMEOUT = float(os.getenv('PICREW_MEDIA_PROCESSING_TIMEOUT', '120'))
 
 # Default configs
 PREPARE_MINUTES = 30
@@ -59,38 +77,141 @@ class FestivalConfig:
     prepare_status_id: IdType | None = None
     question_status_id: IdType | None = None
     entries_status_id: IdType | None = None
+    image_count: int = 1
+    # Uploaded along with the question; unattached media outlive a restart on the server
+    answer_media_ids: list[IdType] | None = None
+
+    collector: EntryCollector = field(init=False, repr=False, compare=False)
+    prepared_ahead: bool = field(default=False, init=False, repr=False, compare=False)
+    answer_media_ready: bool = field(default=False, init=False, repr=False, compare=False)
+    # Encoded image pages, kept until they are posted
+    question_images: list[bytes] | None = field(default=None, init=False, repr=False, compare=False)
+    answer_images: list[bytes] | None = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.collector = EntryCollector(self.allow_multi, MAX_ENTRY)
+
+    def to_state(self) -> dict:
+        return {
+            'request_noti_id': self.request_noti_id,
+            'picrew_link': self.picrew_link,
+            'description': self.description,
+            'prepare_end': self.prepare_end.isoformat(),
+            'name_reveal_at': self.name_reveal_at.isoformat(),
+            'answer_reveal_at': self.answer_reveal_at.isoformat(),
+            'allow_multi': self.allow_multi,
+            'state': self.state.name,
+            'entries': list(self.entries),
+            'prepare_status_id': self.prepare_status_id,
+            'question_status_id': self.question_status_id,
+            'entries_status_id': self.entries_status_id,
+            'image_count': self.image_count,
+            'answer_media_ids': self.answer_media_ids,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'FestivalConfig':
+        return cls(
+            state['request_noti_id'],
+            state['picrew_link'],
+            state['description'],
+            datetime.datetime.fromisoformat(state['prepare_end']),
+            datetime.datetime.fromisoformat(state['name_reveal_at']),
+            datetime.datetime.fromisoformat(state['answer_reveal_at']),
+            state['allow_multi'],
+            FestivalState[state['state']],
+            set(state['entries']),
+            state['prepare_status_id'],
+            state['question_status_id'],
+            state['entries_status_id'],
+            state.get('image_count', 1),
+            state.get('answer_media_ids'),
+        )
 
+    @property
+    def taking_entries(self) -> bool:
+        """Still in PREPARE and not closed for rendering"""
+        return self.state == FestivalState.PREPARE and not self.collector.closed
 
-class Bot:
+    @property
+    def question_image_paths(self) -> list[str]:
+        return [
+            common.question_image_path(self.prepare_status_id, drawer.IMAGE_EXTENSION, page)
+            for page in range(self.image_count)
+        ]
+
+    @property
+    def answer_image_paths(self) -> list[str]:
+        return [
+            common.answer_image_path(self.prepare_status_id, drawer.IMAGE_EXTENSION, page)
+            for page in range(self.image_count)
+        ]
+
+    def question_image_files(self) -> list[IO[bytes] | str]:
+        return image_files(self.question_images, self.question_image_paths)
 
-    RE_PREPARE = re.compile(r'^마감: (?P<time>.+)$', re.M)
-    RE_NAME_REVEAL = re.compile(r'^참가자 공개: (?P<time>.+)$', re.M)
-    RE_ANSWER_REVEAL = re.compile(r'^정답 공개: (?P<time>.+)$', re.M)
-    RE_ALLOW_MULTI = re.compile(r'^다중참가$', re.M)
-    RE_URL = re.compile(r'(?:URL|주소): (.+)$', re.M)
+    def answer_image_files(self) -> list[IO[bytes] | str]:
+        return image_files(self.answer_images, self.answer_image_paths)
+
+
+def image_files(images: list[bytes] | None, paths: list[str]) -> list[IO[bytes] | str]:
+    """The images rendered by this process, or the copies persisted before a restart"""
+    if images is not None:
+        return [io.BytesIO(image) for image in images]
+    return list(paths)
+
+
+def id_order(object_id: IdType) -> tuple[int, str]:
+    """Sort key in the order Mastodon hands out ids, which may come as str or int"""
+    # Decimal ids of different lengths would misorder as plain strings
+    text = str(object_id)
+    return len(text), text
+
+
+class Bot:
 
     RE_TIME = re.compile(r'^(?:(?P<hours>\d{1,2})시간|(?P<minutes>\d{1,3})분|(?P<abshour>\d{2}):(?P<absminute>\d{2}))$')
     RE_IMMEDIATE = re.compile(r'^(?:즉시|바로)$')
 
     def __init__(self, mastodon_instance, mastodon_access_token):
         self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
-        self.mastodon = mastodon.Mastodon(
+        self.mastodon = MastodonClient(mastodon.Mastodon(
             access_token=mastodon_access_token,
-            api_base_url=mastodon_instance
-        )
+            api_base_url=mastodon_instance,
+            # MastodonClient paces and retries on its own
+            ratelimit_method='throw',
+        ))
         self.me = self.mastodon.me()
         self.domain = self.mastodon.instance().domain
         self.logger.info(f'Bot initialized: {self.full_acct(self.me.acct)}')
 
         self.last_mention_id: IdType | None = None
-        self.current_festival: FestivalConfig | None = None
+        self.notification_cursor: IdType | None = None
+        # Running festivals by prepare_status_id
+        self.festivals: dict[IdType, FestivalConfig] = {}
+        self.prefetcher = drawer.TilePrefetcher()
+        self.render_pool = RenderPool()
+        # A question and an answer upload per page, all at once
+        self.upload_executor = ThreadPoolExecutor(max_workers=2 * drawer.MAX_PAGES, thread_name_prefix='upload')
+        self.store = StateStore(common.STATE_DB_PATH)
 
         self.load()
 
     def run(self):
+        if stream.STREAMING:
+            self.run_streaming()
+            return
+
+        next_poll = time.monotonic()
         while True:
             try:
-                self.do_job()
+                with metrics.LOOP_SECONDS.time():
+                    if time.monotonic() >= next_poll:
+                        self.do_job()
+                        next_poll = time.monotonic() + POLL_SECONDS
+                    else:
+                        self.check_festival()
+                        self.save()
             except KeyboardInterrupt:
                 self.logger.info('Interrupted by user')
                 break
@@ -98,32 +219,159 @@ class Bot:
                 self.logger.exception(e)
                 self.logger.error('Error occurred. But continue to run')
 
-            time.sleep(60)
+            try:
+                time.sleep(self.seconds_until_wakeup(next_poll - time.monotonic()))
+            except KeyboardInterrupt:
+                self.logger.info('Interrupted by user')
+                break
+
+    def run_streaming(self):
+        mention_stream = stream.MentionStream(self.mastodon.api)
+        mention_stream.start()
+        self.logger.info('Streaming notifications')
+
+        while True:
+            try:
+                with metrics.LOOP_SECONDS.time():
+                    if mention_stream.needs_backfill():
+                        self.logger.info('Backfilling notifications')
+                        self.do_job()
+                    else:
+                        self.check_festival()
+                        self.save()
+
+                if notification := mention_stream.get(timeout=self.seconds_until_wakeup(POLL_SECONDS)):
+                    with metrics.LOOP_SECONDS.time():
+                        if mention_stream.needs_backfill():
+                            # It came after a reconnect; what the stream missed is older and goes first
+                            self.logger.info('Backfilling notifications')
+                            self.check_notifications()
+                        self.handle_streamed(notification)
+                        self.save()
+            except KeyboardInterrupt:
+                self.logger.info('Interrupted by user')
+                mention_stream.close()
+                break
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.error('Error occurred. But continue to run')
 
     def do_job(self):
+        self.check_festival()
+        self.check_notifications()
+        self.save()
+
+    def seconds_until_wakeup(self, limit: float) -> float:
+        """Time to sleep until the next festival deadline, but no more than limit"""
+        now = datetime.datetime.now().astimezone()
+        deadlines = [deadline for deadline in self.upcoming_deadlines() if deadline > now]
+        if deadlines:
+            limit = min(limit, (min(deadlines) - now).total_seconds())
+        return max(limit, 0)
+
+    def upcoming_deadlines(self) -> list[datetime.datetime]:
+        deadlines = []
+        for festival in self.festivals.values():
+            if festival.state == FestivalState.PREPARE:
+                deadlines += [festival.prepare_end - PREPARE_AHEAD, festival.prepare_end]
+            elif festival.state == FestivalState.QUESTION_PUBLISHED:
+                deadlines += [festival.name_reveal_at, festival.answer_reveal_at - ANSWER_UPLOAD_AHEAD]
+            else:
+                deadlines += [festival.answer_reveal_at - ANSWER_UPLOAD_AHEAD, festival.answer_reveal_at]
+        return deadlines
+
+    def check_festival(self):
         now = datetime.datetime.now().astimezone()
 
-        if current_festival := self.current_festival:
-            if now >= current_festival.prepare_end and self.current_festival.state == FestivalState.PREPARE:
-                self.logger.info('Prepare end')
-                self.prepare_end()
-            if now >= current_festival.name_reveal_at \
-                    and current_festival.state == FestivalState.QUESTION_PUBLISHED:
-                self.logger.info('Name reveal')
-                self.reveal_entries()
-            if now >= current_festival.answer_reveal_at \
-                    and current_festival.state == FestivalState.NAME_REVEALED:
-                self.logger.info('Answer reveal')
-                self.reveal_answer()
+        for festival in list(self.festivals.values()):
+            # Every job advances the festival, so run until nothing is due; once each at most
+            done: set[str] = set()
+            try:
+                while (job := self.next_due_job(festival, now)) and job not in done:
+                    done.add(job)
+                    with metrics.JOB_SECONDS.time(job=job):
+                        getattr(self, job)(festival)
+            except Exception as e:
+                # A failing festival must not hold up the others or the notifications
+                self.logger.exception(e)
+                self.logger.error(f'Error occurred in festival {festival.prepare_status_id}. But continue to run')
+
+    def next_due_job(self, festival: FestivalConfig, now: datetime.datetime) -> str | None:
+        """Name of the Bot method that should run next for the festival"""
+        if festival.prepare_status_id not in self.festivals:
+            # Ended
+            return None
+
+        if festival.state == FestivalState.PREPARE:
+            if now >= festival.prepare_end - PREPARE_AHEAD and not festival.prepared_ahead:
+                return 'prepare_ahead'
+            if now >= festival.prepare_end:
+                self.logger.info(f'Prepare end: {festival.prepare_status_id}')
+                return 'prepare_end'
+            return None
+
+        if now >= festival.name_reveal_at \
+                and festival.state == FestivalState.QUESTION_PUBLISHED:
+            self.logger.info(f'Name reveal: {festival.prepare_status_id}')
+            return 'reveal_entries'
+        if now >= festival.answer_reveal_at \
+                and festival.state == FestivalState.NAME_REVEALED:
+            self.logger.info(f'Answer reveal: {festival.prepare_status_id}')
+            return 'reveal_answer'
+        if now >= festival.answer_reveal_at - ANSWER_UPLOAD_AHEAD and not festival.answer_media_ready:
+            return 'prepare_answer_media'
+        return None
+
+    def find_festival(self, status: Status) -> FestivalConfig | None:
+        """The festival a reply belongs to"""
+        if status.in_reply_to_id is None:
+            return None
+        return self.festivals.get(status.in_reply_to_id)
 
+    def check_notifications(self):
+        """Page forward from the cursor until caught up, oldest first"""
         self.logger.debug('Checking notifications...')
-        notifications = self.mastodon.notifications(types=['mention'])
-        for noti in reversed(notifications):
-            if self.last_mention_id and noti.status.id <= self.last_mention_id:
-                continue
-            self.process_mention(noti)
 
-        self.save()
+        if self.notification_cursor is None:
+            # No cursor yet; start from the latest page
+            notifications = self.mastodon.notifications(types=['mention'], limit=NOTIFICATION_PAGE_SIZE)
+            for noti in reversed(notifications):
+                self.handle_notification(noti)
+            if notifications:
+                self.notification_cursor = notifications[0].id
+                self.save()
+            return
+
+        while True:
+            notifications = self.mastodon.notifications(
+                types=['mention'], min_id=self.notification_cursor, limit=NOTIFICATION_PAGE_SIZE)
+            if not notifications:
+                break
+
+            for noti in reversed(notifications):
+                self.handle_notification(noti)
+
+            self.notification_cursor = notifications[0].id
+            self.save()
+
+            if len(notifications) < NOTIFICATION_PAGE_SIZE:
+                break
+
+    def handle_streamed(self, notification: Notification):
+        """Handle a mention from the stream, once the gap before it is backfilled"""
+        if self.handle_notification(notification):
+            # Everything older was handled too, so the next backfill can start here
+            self.notification_cursor = notification.id
+
+    def handle_notification(self, notification: Notification) -> bool:
+        """Process the mention unless it was already; True if it was processed now"""
+        status = notification.status
+        if status is None:
+            return False
+        if self.last_mention_id and id_order(status.id) <= id_order(self.last_mention_id):
+            return False
+        self.process_mention(notification)
+        return True
 
     def process_mention(self, notification: Notification):
         status: Status = notification.status
@@ -131,40 +379,46 @@ class Bot:
         if reply_visibility == 'public':
             reply_visibility = 'unlisted'
 
-        if self.search_picrew_link(status):
+        if parse_status(status).picrew_link:
             self.logger.info(f'Picrew detected: {status.url}')
-            if self.current_festival is None:
+            if len(self.festivals) < MAX_FESTIVALS:
                 self.start_festival(notification)
             else:
-                self.logger.info('Existing festival is not ended yet')
+                self.logger.info('Too many festivals are running')
                 # Mention that festival already running
-                msg = f'@{status.account.acct} {messages.ALREADY_RUNNING}'
+                reason = messages.ALREADY_RUNNING if MAX_FESTIVALS == 1 else messages.TOO_MANY_RUNNING
+                msg = f'@{status.account.acct} {reason}'
                 self.mastodon.status_post(msg, in_reply_to_id=status.id, visibility=reply_visibility)
         elif status.media_attachments:
-            if not self.current_festival:
+            festival = self.find_festival(status)
+            if not self.festivals:
                 self.logger.info(f'Image detected: {status.url}, But no festival is running')
                 # Mention that no festival is running
                 msg = f'@{status.account.acct} {messages.NO_RUNNING}'
                 self.mastodon.status_post(msg, in_reply_to_id=status.id, visibility=reply_visibility)
-            elif self.current_festival.state != FestivalState.PREPARE:
+            elif festival and festival.taking_entries:
+                self.logger.info(f'Image detected: {status.url}')
+                self.collect_entry(festival, status)
+            elif festival or not any(f.taking_entries for f in self.festivals.values()):
                 self.logger.info(f'Image detected: {status.url}, But not in prepare state')
                 # Mention that not in prepare state
                 msg = f'@{status.account.acct} {messages.NOT_IN_PREPARE}'
                 self.mastodon.status_post(msg, in_reply_to_id=status.id, visibility=reply_visibility)
             else:
-                self.logger.info(f'Image detected: {status.url}')
+                self.logger.info(f'Image detected: {status.url}, But not a reply to any festival')
 
         self.last_mention_id = status.id
 
     def start_festival(self, notification: Notification):
         status = notification.status
         self.logger.info('Festival started')
-        picrew_link = self.search_picrew_link(status)
+        parsed = parse_status(status)
+        picrew_link = parsed.picrew_link
         assert picrew_link is not None
 
-        content = self.plain_text(status)
+        request = parse_request(parsed.text, (picrew_link, f'@{self.me.acct}'))
         abstime = status.created_at.astimezone()
-        prepare_end, name_reveal_at, answer_reveal_at = self.parse_festival_schedule(content, abstime)
+        prepare_end, name_reveal_at, answer_reveal_at = self.parse_festival_schedule(request, abstime)
 
         # Check if the festival is too long
         if answer_reveal_at - abstime > MAX_DURATION:
@@ -178,7 +432,7 @@ class Bot:
                 visibility=reply_visibility)
             return
 
-        # allow_multi = bool(self.RE_ALLOW_MULTI.search(content))
+        # allow_multi = request.allow_multi
         allow_multi = True  # FIXME: Not supported yet
 
         self.logger.info(f'Picrew link: {picrew_link}')
@@ -186,21 +440,11 @@ class Bot:
         self.logger.info(f'Name reveal at: {name_reveal_at}')
         self.logger.info(f'Answer reveal at: {answer_reveal_at}')
 
-        # Support festival description
-        description = content
-        description = description.replace(picrew_link, '').replace(f'@{self.me.acct}', '')
-        description = self.RE_PREPARE.sub('', description)
-        description = self.RE_NAME_REVEAL.sub('', description)
-        description = self.RE_ANSWER_REVEAL.sub('', description)
-        description = self.RE_ALLOW_MULTI.sub('', description)
-        description = self.RE_URL.sub('', description)
-        description = description.strip()
-
         # TODO: Delete if failed to post
-        self.current_festival = FestivalConfig(
+        festival = FestivalConfig(
             notification.id,
             picrew_link,
-            description or None,
+            request.description,
             prepare_end,
             name_reveal_at,
             answer_reveal_at,
@@ -208,18 +452,17 @@ class Bot:
         )
 
         # Post that festival started
-        msg = self.create_started_message(status)
+        msg = self.create_started_message(festival, status)
         try:
             prepare_status_id = self.mastodon.status_post(msg, visibility='public').id
         except mastodon.MastodonError:
             # Retry without description
-            msg = self.create_started_message(status, desc_as_link=True)
+            msg = self.create_started_message(festival, status, desc_as_link=True)
             try:
                 prepare_status_id = self.mastodon.status_post(msg, visibility='public').id
             except:
                 raise Exception('Failed to post')
         except Exception as e:
-            self.current_festival = None
             reply_visibility = status.visibility
             if reply_visibility == 'public':
                 reply_visibility = 'unlisted'
@@ -227,107 +470,196 @@ class Bot:
             self.mastodon.status_post(messages.FESTIVAL_FAILED, in_reply_to_id=status.id, visibility=reply_visibility)
             return
 
-        self.current_festival.prepare_status_id = prepare_status_id
+        festival.prepare_status_id = prepare_status_id
+        self.festivals[prepare_status_id] = festival
 
-    def prepare_end(self):
-        assert self.current_festival is not None
-        assert self.current_festival.state == FestivalState.PREPARE
+    def collect_entry(self, festival: FestivalConfig, status: Status):
+        if status.in_reply_to_id != festival.prepare_status_id:
+            return
 
-        images: list[tuple[str, MediaAttachment]] = []  # full_acct, media_attachment
+        if festival.collector.needs_backfill:
+            # Entries from before a restart go first, or a full festival would turn them away for later ones
+            try:
+                self.backfill_entries(festival)
+            except mastodon.MastodonError as e:
+                self.logger.warning(f'Failed to backfill entries: {e}')
+        self.add_entry(festival, status)
 
-        # Collect entries
-        # : Beside of notifications, Check start_message's replies
-        self.logger.debug(f'Collecting entries for {self.current_festival.prepare_status_id}')
-        assert self.current_festival.prepare_status_id is not None
-        mentions = self.mastodon.status_context(self.current_festival.prepare_status_id).descendants
-
-        for status in mentions:
-            acct = self.full_acct(status.account.acct)
-            if not self.current_festival.allow_multi and acct in self.current_festival.entries:
-                # FIXME: Use last image
-                continue
-
-            attachments = status.media_attachments
-            if not self.current_festival.allow_multi:
-                attachments = attachments[:1]
-
-            for media in attachments:
-                images.append((self.full_acct(status.account.acct), media))
-            self.current_festival.entries.add(self.full_acct(status.account.acct))
-            if len(images) >= MAX_ENTRY:
-                images = images[:MAX_ENTRY]
+    def add_entry(self, festival: FestivalConfig, status: Status):
+        if status.in_reply_to_id != festival.prepare_status_id:
+            return
+
+        acct = self.full_acct(status.account.acct)
+        if accepted := festival.collector.add(acct, status):
+            festival.entries.add(acct)
+            # Have the tiles ready before prepare_end
+            self.prefetcher.submit(accepted)
+
+    def backfill_entries(self, festival: FestivalConfig):
+        """Page through mentions since the festival request, oldest first"""
+        collector = festival.collector
+        self.logger.info(f'Backfilling entries for {festival.prepare_status_id}')
+
+        min_id = festival.request_noti_id
+        while not collector.full:
+            page = self.mastodon.notifications(types=['mention'], min_id=min_id, limit=NOTIFICATION_PAGE_SIZE)
+            if not page:
                 break
+            for noti in reversed(page):
+                self.add_entry(festival, noti.status)
+            min_id = page[0].id
+
+        collector.needs_backfill = False
+
+    def prepare_ahead(self, festival: FestivalConfig):
+        """Recover entries missed while the bot was down, so their tiles are fetched in time"""
+        festival.prepared_ahead = True
+
+        if festival.collector.needs_backfill:
+            try:
+                self.backfill_entries(festival)
+            except mastodon.MastodonError as e:
+                self.logger.warning(f'Failed to backfill entries: {e}')
+
+    def prepare_answer_media(self, festival: FestivalConfig):
+        """Make sure the answer media are processed before the reveal, so it only has to post"""
+        timeout = (festival.answer_reveal_at - datetime.datetime.now().astimezone()).total_seconds()
+        try:
+            self.wait_for_media(self.answer_media(festival), max(timeout, 0))
+            festival.answer_media_ready = True
+        except Exception as e:
+            # Try again at reveal time
+            self.logger.warning(f'Answer media not ready ahead of the reveal: {e}')
+
+    def prepare_end(self, festival: FestivalConfig):
+        images = self.close_entries(festival)
+        if images is None:
+            return
 
-        if len(self.current_festival.entries) < MIN_ENTRY:
+        # Mentions are still answered while the render runs
+        self.render_images(festival, images, idle=self.check_notifications)
+        # The answer is uploaded now too, so it has long been processed when it is revealed
+        questions = self.post_images(festival.question_image_files())
+        answers = self.post_images(festival.answer_image_files())
+        media = self.wait_for_media([future.result() for future in questions])
+        self.publish_question(festival, media)
+        self.keep_answer_media(festival, answers)
+
+    def close_entries(self, festival: FestivalConfig) -> list[tuple[str, MediaAttachment]] | None:
+        """Stop taking entries and return their images, or cancel if there are too few"""
+        assert festival.state == FestivalState.PREPARE
+
+        # Collect entries
+        # : Take in mentions that arrived since the last poll
+        self.logger.debug(f'Collecting entries for {festival.prepare_status_id}')
+        self.check_notifications()
+        collector = festival.collector
+        if collector.needs_backfill:
+            self.backfill_entries(festival)
+
+        collector.closed = True
+        images = list(collector.images)
+        festival.entries = set(collector.accts)
+
+        if len(festival.entries) < MIN_ENTRY:
             # End festival
             msg = messages.FESTIVAL_CANCELLED
-            self.mastodon.status_post(msg, in_reply_to_id=self.current_festival.prepare_status_id, visibility='public')
-            self.current_festival = None
-            return
+            self.mastodon.status_post(msg, in_reply_to_id=festival.prepare_status_id, visibility='public')
+            self.end_festival(festival)
+            return None
 
-        self.last_mention_id = mentions[-1].id
+        return images
 
+    def render_images(self, festival: FestivalConfig, images: list[tuple[str, MediaAttachment]],
+                      idle: Callable[[], object] | None = None):
+        """Render the festival's pages, calling idle now and then until they are done"""
         # Generate question/answer image
-        drawer.generate_images(images)
+        self.prefetcher.wait(PREFETCH_WAIT_SECONDS)
+        questions, answers = drawer.generate_images(images, functools.partial(self.render_pool.render, idle=idle))
+        festival.question_images, festival.answer_images = questions, answers
+        festival.image_count = len(questions)
+        festival.answer_media_ids = None
+        festival.answer_media_ready = False
 
-        also_reveal_entries = self.current_festival.name_reveal_at == self.current_festival.prepare_end
+        if common.PERSIST_IMAGES:
+            drawer.save_images(questions, festival.question_image_paths)
+            drawer.save_images(answers, festival.answer_image_paths)
+
+    def publish_question(self, festival: FestivalConfig, media: list[MediaAttachment]):
+        also_reveal_entries = festival.name_reveal_at == festival.prepare_end
 
         # Forge status with question image
-        media = self.upload_media(common.QUESTION_IMAGE_PATH)
-        msg = messages.question(list(self.current_festival.entries) if also_reveal_entries else None)
+        msg = messages.question(list(festival.entries) if also_reveal_entries else None)
 
         status_id = self.mastodon.status_post(
             msg,
-            in_reply_to_id=self.current_festival.prepare_status_id,
-            media_ids=[media.id],
+            in_reply_to_id=festival.prepare_status_id,
+            media_ids=[attachment.id for attachment in media],
             visibility='public').id
-        self.current_festival.question_status_id = status_id
+        self.log_lateness('Question', festival.prepare_end)
+        festival.question_status_id = status_id
+        festival.question_images = None
 
-        self.current_festival.state = FestivalState.QUESTION_PUBLISHED
+        festival.state = FestivalState.QUESTION_PUBLISHED
 
         if also_reveal_entries:
-            self.current_festival.state = FestivalState.NAME_REVEALED
-            self.current_festival.entries_status_id = status_id
+            festival.state = FestivalState.NAME_REVEALED
+            festival.entries_status_id = status_id
 
-    def reveal_entries(self):
-        assert self.current_festival is not None
-        assert self.current_festival.state == FestivalState.QUESTION_PUBLISHED
+    def reveal_entries(self, festival: FestivalConfig):
+        assert festival.state == FestivalState.QUESTION_PUBLISHED
 
-        msg = messages.entries(list(self.current_festival.entries))
+        msg = messages.entries(list(festival.entries))
         status_id = self.mastodon.status_post(
             msg,
-            in_reply_to_id=self.current_festival.question_status_id,
+            in_reply_to_id=festival.question_status_id,
             visibility='unlisted').id
-        self.current_festival.entries_status_id = status_id
+        self.log_lateness('Entries', festival.name_reveal_at)
+        festival.entries_status_id = status_id
 
-        self.current_festival.state = FestivalState.NAME_REVEALED
+        festival.state = FestivalState.NAME_REVEALED
 
-    def reveal_answer(self):
-        assert self.current_festival is not None
-        assert self.current_festival.state == FestivalState.NAME_REVEALED
+    def reveal_answer(self, festival: FestivalConfig):
+        assert festival.state == FestivalState.NAME_REVEALED
 
         # Post status with answer image
-        media = self.upload_media(common.ANSWER_IMAGE_PATH)
+        if not festival.answer_media_ready:
+            self.wait_for_media(self.answer_media(festival))
+            festival.answer_media_ready = True
         msg = messages.ANSWER
 
         self.mastodon.status_post(
             msg,
-            in_reply_to_id=self.current_festival.entries_status_id,
-            media_ids=[media.id],
+            in_reply_to_id=festival.entries_status_id,
+            media_ids=festival.answer_media_ids,
             visibility='public')
+        self.log_lateness('Answer', festival.answer_reveal_at)
 
         # End festival
-        self.current_festival = None
+        self.end_festival(festival)
+
+    def end_festival(self, festival: FestivalConfig):
+        assert festival.prepare_status_id is not None
+        self.festivals.pop(festival.prepare_status_id, None)
+        festival.question_images = festival.answer_images = None
+        for path in festival.question_image_paths + festival.answer_image_paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-    def create_started_message(self, status, desc_as_link: bool = False) -> str:
-        assert self.current_festival is not None
+    def log_lateness(self, phase: str, scheduled: datetime.datetime):
+        lateness = datetime.datetime.now().astimezone() - scheduled
+        metrics.LATENESS_SECONDS.observe(lateness.total_seconds(), phase=phase.lower())
+        self.logger.info(f'{phase} posted {lateness.total_seconds():+.1f}s from schedule')
 
+    def create_started_message(self, festival: FestivalConfig, status, desc_as_link: bool = False) -> str:
         requester = self.full_acct(status.account.acct)
-        picrew_link = f'{self.current_festival.picrew_link}'
-        prepare_end = f'{self.current_festival.prepare_end:%H:%M}'
-        name_reveal_at = f'{self.current_festival.name_reveal_at:%H:%M}'
-        answer_reveal_at = f'{self.current_festival.answer_reveal_at:%H:%M}'
-        description = self.current_festival.description if not desc_as_link else status.url
+        picrew_link = f'{festival.picrew_link}'
+        prepare_end = f'{festival.prepare_end:%H:%M}'
+        name_reveal_at = f'{festival.name_reveal_at:%H:%M}'
+        answer_reveal_at = f'{festival.answer_reveal_at:%H:%M}'
+        description = festival.description if not desc_as_link else status.url
 
         if name_reveal_at == prepare_end:
             name_reveal_at = messages.NAME_REVEALED_AT_SAME_TIME
@@ -343,124 +675,148 @@ class Bot:
 
         return msg
 
-    def upload_media(self, path: str):
-        media = self.mastodon.media_post(path)
+    def post_images(self, media_files: list[IO[bytes] | str]) -> list[Future]:
+        """Start uploading every file at once; the futures resolve to media that may still be processing"""
+        return [self.upload_executor.submit(self.post_media, media_file) for media_file in media_files]
+
+    def post_media(self, media_file: IO[bytes] | str, mime_type: str = drawer.IMAGE_MIME_TYPE) -> MediaAttachment:
+        start = time.monotonic()
+        media = self.mastodon.media_post(media_file, mime_type=mime_type)
+        elapsed = time.monotonic() - start
+        metrics.UPLOAD_SECONDS.observe(elapsed)
+        self.logger.info(f'Uploaded media {media.id} in {elapsed:.1f}s')
+        return media
+
+    def keep_answer_media(self, festival: FestivalConfig, uploads: list[Future]):
+        try:
+            festival.answer_media_ids = [future.result().id for future in uploads]
+        except Exception as e:
+            # Uploaded again before the reveal
+            self.logger.warning(f'Failed to upload answer image ahead: {e}')
+            festival.answer_media_ids = None
+        festival.answer_media_ready = False
+
+    def answer_media(self, festival: FestivalConfig) -> list[MediaAttachment]:
+        """The uploaded answer media as the server has them now, uploading them if there are none"""
+        if festival.answer_media_ids is not None:
+            try:
+                return [self.mastodon.media(media_id) for media_id in festival.answer_media_ids]
+            except mastodon.MastodonNotFoundError:
+                self.logger.warning('Answer media are gone from the server, uploading them again')
+
+        media = [future.result() for future in self.post_images(festival.answer_image_files())]
+        festival.answer_media_ids = [attachment.id for attachment in media]
+        return media
+
+    def wait_for_media(self, media: list[MediaAttachment], timeout: float = MEDIA_PROCESSING_TIMEOUT) \
+            -> list[MediaAttachment]:
+        """Poll media still processing, with backoff, until all are done or timeout seconds pass"""
+        start = time.monotonic()
+        media = list(media)
         try_count = 0
-        while 'url' not in media or media.url is None:
+        while pending := [i for i, attachment in enumerate(media) if not self.media_processed(attachment)]:
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'{len(pending)} media not processed in {timeout:.0f}s')
             try_count += 1
-            sleep_duration = math.log2(1 + try_count)
-            time.sleep(sleep_duration)
-            try:
-                media = self.mastodon.media(media)
-            except Exception:
-                raise
+            time.sleep(min(math.log2(1 + try_count), remaining))
+            for i in pending:
+                media[i] = self.mastodon.media(media[i])
+
+        self.log_processing(media, start)
         return media
 
+    def log_processing(self, media: list[MediaAttachment], start: float):
+        waited = time.monotonic() - start
+        metrics.PROCESSING_SECONDS.observe(waited)
+        if media:
+            self.logger.info(f'Media {", ".join(str(attachment.id) for attachment in media)} processed, '
+                             f'waited {waited:.1f}s')
+
+    @staticmethod
+    def media_processed(media: MediaAttachment) -> bool:
+        return 'url' in media and media.url is not None
+
     def full_acct(self, acct: str) -> str:
         if '@' in acct:
             return acct
         return f'{acct}@{self.domain}'
 
     def save(self):
-        states = {
+        meta = {
             'last_noti_id': self.last_mention_id,
-            'current_festival': {
-                'request_noti_id': self.current_festival.request_noti_id,
-                'picrew_link': self.current_festival.picrew_link,
-                'description': self.current_festival.description,
-                'prepare_end': self.current_festival.prepare_end.isoformat(),
-                'name_reveal_at': self.current_festival.name_reveal_at.isoformat(),
-                'answer_reveal_at': self.current_festival.answer_reveal_at.isoformat(),
-                'allow_multi': self.current_festival.allow_multi,
-                'state': self.current_festival.state.name,
-                'entries': list(self.current_festival.entries),
-                'prepare_status_id': self.current_festival.prepare_status_id,
-                'question_status_id': self.current_festival.question_status_id,
-                'entries_status_id': self.current_festival.entries_status_id,
-            } if self.current_festival else None
+            'notification_cursor': self.notification_cursor,
         }
+        festivals = {str(festival.prepare_status_id): festival.to_state() for festival in self.festivals.values()}
 
-        self.logger.debug(f'Saving states: {states}')
-
-        with open(common.STATE_PATH, 'w') as f:
-            json.dump(states, f)
+        if self.store.save(meta, festivals):
+            self.logger.debug(f'Saved states: {meta} {festivals}')
 
     def load(self):
+        meta, festival_states = self.store.load()
+        if not meta:
+            meta, festival_states = self.load_legacy()
+        if not meta:
+            return
+
+        self.logger.debug(f'Loaded states: {meta} {festival_states}')
+        self.last_mention_id = meta['last_noti_id']
+        self.notification_cursor = meta.get('notification_cursor')
+
+        for festival_state in festival_states:
+            festival = FestivalConfig.from_state(festival_state)
+            # Entries seen before the restart are only in the timeline now
+            festival.collector.needs_backfill = True
+            # Only festivals that were announced are saved
+            assert festival.prepare_status_id is not None
+            self.festivals[festival.prepare_status_id] = festival
+
+        self.logger.info(f'States loaded: {self.last_mention_id} {list(self.festivals.values())}')
+
+    def load_legacy(self) -> tuple[dict, list[dict]]:
+        """Read the state.json written by older versions"""
         try:
             with open(common.STATE_PATH, 'r') as f:
                 states = json.load(f)
-                self.logger.debug(f'Loaded states: {states}')
-                self.last_mention_id = states['last_noti_id']
-                if current_festival := states['current_festival']:
-                    self.current_festival = FestivalConfig(
-                        current_festival['request_noti_id'],
-                        current_festival['picrew_link'],
-                        current_festival['description'],
-                        datetime.datetime.fromisoformat(current_festival['prepare_end']),
-                        datetime.datetime.fromisoformat(current_festival['name_reveal_at']),
-                        datetime.datetime.fromisoformat(current_festival['answer_reveal_at']),
-                        current_festival['allow_multi'],
-                        FestivalState[current_festival['state']],
-                        set(current_festival['entries']),
-                        current_festival['prepare_status_id'],
-                        current_festival['question_status_id'],
-                        current_festival['entries_status_id'],
-                    )
-
-            self.logger.info(f'States loaded: {self.last_mention_id} {self.current_festival}')
-
         except (FileNotFoundError, json.JSONDecodeError):
-            pass
+            return {}, []
+
+        festival_states = states.get('festivals', [])
+        if current_festival := states.get('current_festival'):
+            # Written before multiple festivals were supported
+            festival = FestivalConfig.from_state(current_festival)
+            legacy_answer_path = os.path.join(common.STORAGE_PATH, 'answer.webp')
+            if os.path.exists(legacy_answer_path):
+                os.replace(legacy_answer_path, festival.answer_image_paths[0])
+            festival_states.append(current_festival)
+
+        meta = {
+            'last_noti_id': states['last_noti_id'],
+            'notification_cursor': states.get('notification_cursor'),
+        }
+        return meta, festival_states
 
     @classmethod
-    def parse_festival_schedule(cls, content, abstime) \
+    def parse_festival_schedule(cls, request: FestivalRequest, abstime) \
             -> tuple[datetime.datetime, datetime.datetime, datetime.datetime]:
-        if prepare := cls.RE_PREPARE.search(content):
-            prepare_end = cls.parse_time(abstime, prepare.group('time'), default_min=PREPARE_MINUTES)
+        if request.prepare_end:
+            prepare_end = cls.parse_time(abstime, request.prepare_end, default_min=PREPARE_MINUTES)
         else:
             prepare_end = abstime + datetime.timedelta(minutes=PREPARE_MINUTES)
 
-        if name_reveal := cls.RE_NAME_REVEAL.search(content):
-            name_reveal_at = cls.parse_time(prepare_end, name_reveal.group('time'), default_min=NAME_REVEAL_MINUTES)
+        if request.name_reveal_at:
+            name_reveal_at = cls.parse_time(prepare_end, request.name_reveal_at, default_min=NAME_REVEAL_MINUTES)
         else:
             name_reveal_at = prepare_end + datetime.timedelta(minutes=NAME_REVEAL_MINUTES)
 
-        if answer_reveal := cls.RE_ANSWER_REVEAL.search(content):
+        if request.answer_reveal_at:
             answer_reveal_at = cls.parse_time(
-                name_reveal_at, answer_reveal.group('time'), default_min=ANSWER_REVEAL_MINUTES)
+                name_reveal_at, request.answer_reveal_at, default_min=ANSWER_REVEAL_MINUTES)
         else:
             answer_reveal_at = name_reveal_at + datetime.timedelta(minutes=ANSWER_REVEAL_MINUTES)
 
         return prepare_end, name_reveal_at, answer_reveal_at
 
-    @classmethod
-    def search_picrew_link(cls, status) -> str | None:
-        html_doc = html.fromstring(status.content)
-        text = cls.plain_text(status)
-        if matched := cls.RE_URL.search(text):
-            return matched.group(1)
-
-        for link in html_doc.xpath('//a'):
-            href = link.attrib['href']
-            if urlparse(href).netloc in ALLOWED_DOMAINS:
-                return href
-
-        return None
-
-    @staticmethod
-    def plain_text(status) -> str:
-        html_doc = html.fromstring(status.content)
-
-        # Replace <br> with newline
-        for br in html_doc.xpath('//br'):
-            br.tail = '\n' + (br.tail or '')
-
-        # Replace <p> with newline
-        for p in html_doc.xpath('//p'):
-            p.tail = '\n\n' + (p.tail or '')
-
-        return html_doc.text_content().strip()
-
     @classmethod
     def parse_time(cls, abstime: datetime.datetime, timestr: str, default_min: int = 0) -> datetime.datetime:
         # Ensure local timezone
@@ -487,15 +843,8 @@ def main():
     import os
     import sys
 
-    loglevel = os.getenv('PICREW_LOGLEVEL', 'INFO')
+    common.setup_logging(os.getenv('PICREW_LOGLEVEL', 'INFO'))
     logger = logging.getLogger(__package__)
-    logger.setLevel(loglevel)
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(
-        '%(asctime)s:%(levelname)s:%(name)s: %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    ))
-    logger.addHandler(handler)
 
     mastodon_instance = os.getenv('MASTODON_API_BASE_URL')
     mastodon_access_token = os.getenv('MASTODON_ACCESS_TOKEN')
@@ -503,5 +852,16 @@ def main():
         logger.error('MASTODON_BASE_URL and MASTODON_ACCESS_TOKEN must be set')
         sys.exit(1)
 
+    if metrics.METRICS_PORT:
+        metrics.serve()
+
     bot = Bot(mastodon_instance, mastodon_access_token)
-    bot.run()
+
+    from . import runner
+    if runner.ASYNC:
+        try:
+            asyncio.run(runner.AsyncRunner(bot).run())
+        except KeyboardInterrupt:
+            logger.info('Interrupted by user')
+    else:
+        bot.run()
@@ -0,0 +1,172 @@
+import functools
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+import mastodon
+
+from . import metrics
+
+# Calls that can be repeated without side effects; only these are coalesced
+READ_METHODS = {
+    'me',
+    'instance',
+    'notifications',
+    'media',
+    'status',
+    'status_context',
+    'account',
+}
+# Writes that are retried; status_post is made idempotent with an Idempotency-Key
+RETRIED_WRITES = {
+    'status_post',
+}
+
+API_RETRIES = int(os.getenv('PICREW_API_RETRIES', '3'))
+API_BACKOFF_SECONDS = float(os.getenv('PICREW_API_BACKOFF_SECONDS', '1'))
+# Start pacing once this few requests are left in the rate limit window
+RATELIMIT_RESERVE = int(os.getenv('PICREW_RATELIMIT_RESERVE', '30'))
+
+RETRIED_ERRORS = (
+    mastodon.MastodonNetworkError,
+    mastodon.MastodonServerError,
+    mastodon.MastodonRatelimitError,
+)
+
+
+@dataclass
+class EndpointStats:
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    coalesced: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+
+
+class MastodonClient:
+    """Mastodon.py with rate limit pacing, retries, request coalescing and metrics
+
+    Known read and write methods are wrapped; everything else, streaming
+    included, goes straight to the Mastodon instance. Identical reads made
+    while one is in flight share its result. Once the rate limit window
+    runs low, the remaining requests are spread over what is left of it,
+    so the bot slows down instead of hitting 429.
+    """
+
+    def __init__(self, api: mastodon.Mastodon):
+        self.api = api
+        self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        self.lock = threading.Lock()
+        self.in_flight: dict[tuple, Future] = {}
+        self.stats: dict[str, EndpointStats] = {}
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.api, name)
+        if name in READ_METHODS:
+            return functools.partial(self.read, name)
+        if name in RETRIED_WRITES:
+            return functools.partial(self.write, name)
+        if callable(attr) and not name.startswith('stream_'):
+            return functools.partial(self.call, name, 1)
+        return attr
+
+    def read(self, name: str, *args, **kwargs):
+        key = (name, repr(args), repr(sorted(kwargs.items())))
+        with self.lock:
+            shared = self.in_flight.get(key)
+            if shared is None:
+                future: Future = Future()
+                self.in_flight[key] = future
+            else:
+                self.stats.setdefault(name, EndpointStats()).coalesced += 1
+                metrics.API_COALESCED.inc(endpoint=name)
+
+        if shared is not None:
+            return shared.result()
+
+        try:
+            result = self.call(name, API_RETRIES, *args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def write(self, name: str, *args, **kwargs):
+        if name == 'status_post' and not kwargs.get('idempotency_key'):
+            # The server posts a retried status only once
+            kwargs['idempotency_key'] = uuid.uuid4().hex
+        return self.call(name, API_RETRIES, *args, **kwargs)
+
+    def call(self, name: str, attempts: int, *args, **kwargs):
+        stats = self.endpoint(name)
+        attempt = 0
+        while True:
+            self.pace()
+            started = time.monotonic()
+            try:
+                return getattr(self.api, name)(*args, **kwargs)
+            except RETRIED_ERRORS as e:
+                attempt += 1
+                if attempt >= attempts:
+                    self.count(name, stats, errors=1)
+                    raise
+                self.count(name, stats, retries=1)
+                delay = self.retry_delay(e, attempt - 1)
+                self.logger.warning(f'{name} failed ({e!r}), retrying in {delay:.1f}s')
+                time.sleep(delay)
+            except Exception:
+                self.count(name, stats, errors=1)
+                raise
+            finally:
+                elapsed = time.monotonic() - started
+                with self.lock:
+                    stats.calls += 1
+                    stats.seconds += elapsed
+                    stats.max_seconds = max(stats.max_seconds, elapsed)
+                metrics.API_SECONDS.observe(elapsed, endpoint=name)
+
+    def count(self, name: str, stats: EndpointStats, errors: int = 0, retries: int = 0):
+        with self.lock:
+            stats.errors += errors
+            stats.retries += retries
+        if errors:
+            metrics.API_ERRORS.inc(errors, endpoint=name)
+        if retries:
+            metrics.API_RETRIES.inc(retries, endpoint=name)
+
+    def retry_delay(self, error: Exception, attempt: int) -> float:
+        if isinstance(error, mastodon.MastodonRatelimitError):
+            # Wait out the window, with jitter so parallel callers do not return at once
+            return max(self.api.ratelimit_reset - time.time(), 0) + random.uniform(0, API_BACKOFF_SECONDS)
+        # Full jitter exponential backoff
+        return random.uniform(0, API_BACKOFF_SECONDS * 2 ** attempt)
+
+    def pace(self):
+        remaining = self.api.ratelimit_remaining
+        until_reset = self.api.ratelimit_reset - time.time()
+        if remaining > RATELIMIT_RESERVE or until_reset <= 0:
+            return
+
+        delay = until_reset / max(remaining, 1)
+        self.logger.info(f'{remaining} requests left for {until_reset:.0f}s, waiting {delay:.1f}s')
+        time.sleep(delay)
+
+    def endpoint(self, name: str) -> EndpointStats:
+        with self.lock:
+            return self.stats.setdefault(name, EndpointStats())
+
+    @property
+    def ratelimit(self) -> tuple[int, int, float]:
+        """Remaining requests, window size and seconds until the window resets"""
+        return self.api.ratelimit_remaining, self.api.ratelimit_limit, self.api.ratelimit_reset - time.time()
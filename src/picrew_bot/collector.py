@@ -0,0 +1,48 @@
+from mastodon.return_types import MediaAttachment, Status
+from mastodon.types_base import IdType
+
+
+class EntryCollector:
+    """Entry images of one festival, in arrival order
+
+    Entries are added one status at a time as they are seen, so closing
+    the festival never has to walk its whole reply thread.
+    """
+
+    def __init__(self, allow_multi: bool, max_images: int):
+        self.allow_multi = allow_multi
+        self.max_images = max_images
+
+        self.images: list[tuple[str, MediaAttachment]] = []  # full_acct, media_attachment
+        self.accts: set[str] = set()
+        self.status_ids: set[IdType] = set()
+
+        # Set when entries may have arrived while nothing was collecting
+        self.needs_backfill = False
+        # Set once the festival stops taking entries
+        self.closed = False
+
+    @property
+    def full(self) -> bool:
+        return len(self.images) >= self.max_images
+
+    def add(self, acct: str, status: Status) -> list[MediaAttachment]:
+        """Add the images of an entry status and return the ones accepted"""
+        if status.id in self.status_ids or self.full or self.closed:
+            return []
+        self.status_ids.add(status.id)
+
+        if not self.allow_multi and acct in self.accts:
+            # FIXME: Use last image
+            return []
+
+        attachments: list[MediaAttachment] = status.media_attachments
+        if not self.allow_multi:
+            attachments = attachments[:1]
+        attachments = attachments[:self.max_images - len(self.images)]
+        if not attachments:
+            return []
+
+        self.images.extend((acct, media) for media in attachments)
+        self.accts.add(acct)
+        return attachments
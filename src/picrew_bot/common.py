@@ -1,11 +1,39 @@
+import logging
 import os
 
 DEFAULT_FONT_PATH = '/usr/share/fonts/truetype/ubuntu/UbuntuMono-B.ttf'
 
 STORAGE_PATH = os.getenv('PICREW_STORAGE_PATH', 'state')
-QUESTION_IMAGE_PATH = os.path.join(STORAGE_PATH, 'question.webp')
-ANSWER_IMAGE_PATH = os.path.join(STORAGE_PATH, 'answer.webp')
 STATE_PATH = os.path.join(STORAGE_PATH, 'state.json')
+STATE_DB_PATH = os.path.join(STORAGE_PATH, 'state.db')
+TILE_CACHE_PATH = os.path.join(STORAGE_PATH, 'tiles')
+# Keep rendered images on disk so a restart can still reveal the answer
+PERSIST_IMAGES = os.getenv('PICREW_PERSIST_IMAGES', '1') == '1'
+
+
+def question_image_path(festival_id, extension: str = 'webp', page: int = 0) -> str:
+    return os.path.join(STORAGE_PATH, f'question-{festival_id}{page_suffix(page)}.{extension}')
+
+
+def answer_image_path(festival_id, extension: str = 'webp', page: int = 0) -> str:
+    return os.path.join(STORAGE_PATH, f'answer-{festival_id}{page_suffix(page)}.{extension}')
+
+
+def page_suffix(page: int) -> str:
+    # The first page keeps the name used before images were split
+    return f'-{page + 1}' if page else ''
+
+
+def setup_logging(level: int | str):
+    logger = logging.getLogger(__package__)
+    logger.setLevel(level)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s:%(levelname)s:%(name)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
+    ))
+    logger.addHandler(handler)
+
 
 # Ensure directories exist
 os.makedirs(STORAGE_PATH, exist_ok=True)
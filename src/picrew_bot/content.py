@@ -0,0 +1,128 @@
+import functools
+import re
+
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from lxml import etree, html
+
+ALLOWED_DOMAINS = [
+    'picrew.me',
+    'www.neka.cc',
+]
+RE_URL = re.compile(r'(?:URL|주소): (.+)$', re.M)
+
+PARSE_CACHE_SIZE = 256
+
+XPATH_BR = etree.XPath('//br')
+XPATH_P = etree.XPath('//p')
+XPATH_HREF = etree.XPath('//a/@href')
+
+
+@dataclass(frozen=True)
+class ParsedStatus:
+    """What the bot reads from a status, from a single parse of its HTML"""
+    text: str
+    links: tuple[str, ...]
+
+    @functools.cached_property
+    def picrew_link(self) -> str | None:
+        if matched := RE_URL.search(self.text):
+            return matched.group(1)
+
+        for href in self.links:
+            if urlparse(href).netloc in ALLOWED_DOMAINS:
+                return href
+
+        return None
+
+
+def parse_status(status) -> ParsedStatus:
+    return parse_content(status.id, status.content)
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse_content(status_id, content: str) -> ParsedStatus:
+    """Keyed by id and content, so an edited status is parsed again"""
+    html_doc = html.fromstring(content)
+    links = tuple(str(href) for href in XPATH_HREF(html_doc))
+
+    # Replace <br> with newline
+    for br in XPATH_BR(html_doc):
+        br.tail = '\n' + (br.tail or '')
+
+    # Replace <p> with newline
+    for p in XPATH_P(html_doc):
+        p.tail = '\n\n' + (p.tail or '')
+
+    return ParsedStatus(html_doc.text_content().strip(), links)
+
+
+SCHEDULE_DIRECTIVES = {
+    '마감: ': 'prepare_end',
+    '참가자 공개: ': 'name_reveal_at',
+    '정답 공개: ': 'answer_reveal_at',
+}
+SCHEDULE_PREFIXES = tuple(SCHEDULE_DIRECTIVES)
+MULTI_FLAG = '다중참가'
+URL_PREFIXES = ('URL: ', '주소: ')
+
+
+@dataclass(frozen=True)
+class FestivalRequest:
+    """Directives of a festival request; times are as written, for Bot.parse_time"""
+    prepare_end: str | None = None
+    name_reveal_at: str | None = None
+    answer_reveal_at: str | None = None
+    allow_multi: bool = False
+    description: str | None = None
+
+
+def parse_request(text: str, removed: tuple[str, ...] = ()) -> FestivalRequest:
+    """Read the directives and the description of a request in one pass over its lines
+
+    A directive takes a whole line: `마감: <time>`, `참가자 공개: <time>`,
+    `정답 공개: <time>` or `다중참가`, the first of each counting. The
+    description is the rest of the text, with the strings in removed cut
+    out, directive lines emptied and URL directives cut off their line.
+    """
+    values: dict = {}
+    lines = text.split('\n')
+    for i, line in enumerate(lines):
+        # Every directive but the flag has ': ', so most lines are passed over here
+        if ': ' in line:
+            if name := directive(line):
+                values.setdefault(name, line[line.index(': ') + 2:])
+        elif line == MULTI_FLAG:
+            values['allow_multi'] = True
+
+        for string in removed:
+            line = line.replace(string, '')
+        if ': ' in line:
+            if directive(line):
+                line = ''
+            elif (url := find_url(line)) != -1:
+                line = line[:url]
+        elif line == MULTI_FLAG:
+            line = ''
+        lines[i] = line
+
+    return FestivalRequest(**values, description='\n'.join(lines).strip() or None)
+
+
+def directive(line: str) -> str | None:
+    """The schedule field line sets, if it is a schedule directive"""
+    if not line.startswith(SCHEDULE_PREFIXES):
+        return None
+    prefix = line[:line.index(': ') + 2]
+    return SCHEDULE_DIRECTIVES[prefix] if len(line) > len(prefix) else None
+
+
+def find_url(line: str) -> int:
+    """Where the first URL directive with a value starts in line, or -1"""
+    found = [(start, start + len(prefix)) for prefix in URL_PREFIXES if (start := line.find(prefix)) != -1]
+    if not found:
+        return -1
+    # The first one ends the line, so if it has no value no other does
+    start, end = min(found)
+    return start if end < len(line) else -1
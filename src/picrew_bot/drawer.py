@@ -1,85 +1,199 @@
+import contextlib
 import io
+import logging
 import math
 import os
 import random
+import struct
+import threading
+import time
+
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 
 import httpx
 
-from mastodon.return_types import MediaAttachment
-from PIL import Image, ImageDraw, ImageFont
+from mastodon.return_types import MediaAttachment, MediaAttachmentMetadataContainer
+from PIL import Image, ImageDraw, ImageFile
 
 from . import common
+from . import fonts
+from . import metrics
+from .tilecache import TileCache
 
 CELL_SIZE = 600
 CELL_GAP = 30
+# Cells shrink from CELL_SIZE to keep a grid within CANVAS_SIZE, but not below MIN_CELL_SIZE;
+# past that the entries are split over up to MAX_PAGES images (Mastodon takes 4 per post)
+CANVAS_SIZE = int(os.getenv('PICREW_CANVAS_SIZE', '2560'))
+MIN_CELL_SIZE = int(os.getenv('PICREW_MIN_CELL_SIZE', '300'))
+MAX_PAGES = int(os.getenv('PICREW_MAX_PAGES', '4'))
 NAME_POSITION = (0.5, 0.8)
 FONT_PATH = os.getenv('FONT_PATH', common.DEFAULT_FONT_PATH)
-ANSWER_FONT_SIZE = CELL_SIZE // 20
+ANSWER_FONT_RATIO = 1 / 20  # of the cell size
 NUMBER_FONT_SIZE = CELL_GAP
 FONT_BACKGROUND = 'white'
 FONT_COLOR = 'black'
 FONT_GAP = 5
 
+IMAGE_FORMAT = os.getenv('PICREW_IMAGE_FORMAT', 'WEBP').upper()
+IMAGE_QUALITY = int(os.getenv('PICREW_IMAGE_QUALITY', '80'))
+IMAGE_METHOD = int(os.getenv('PICREW_IMAGE_METHOD', '4'))  # WebP effort, 0 (fast) to 6 (small)
+IMAGE_LOSSLESS = os.getenv('PICREW_IMAGE_LOSSLESS', '0') == '1'
+IMAGE_MAX_DIMENSION = int(os.getenv('PICREW_IMAGE_MAX_DIMENSION', '0'))  # 0 for no limit
+# Lower the quality down to IMAGE_MIN_QUALITY until an image fits; 0 to encode once
+IMAGE_MAX_BYTES = int(os.getenv('PICREW_IMAGE_MAX_BYTES', '0'))
+IMAGE_MIN_QUALITY = int(os.getenv('PICREW_IMAGE_MIN_QUALITY', '30'))
+
+IMAGE_TYPES = {
+    'WEBP': ('image/webp', 'webp'),
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+}
+IMAGE_MIME_TYPE, IMAGE_EXTENSION = IMAGE_TYPES[IMAGE_FORMAT]
+
+DOWNLOAD_CONCURRENCY = int(os.getenv('PICREW_DOWNLOAD_CONCURRENCY', '8'))
+DOWNLOAD_TIMEOUT = float(os.getenv('PICREW_DOWNLOAD_TIMEOUT', '10'))
+MAX_DOWNLOAD_BYTES = int(os.getenv('PICREW_MAX_DOWNLOAD_BYTES', str(16 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv('PICREW_MAX_IMAGE_PIXELS', str(8192 * 8192)))
+# JPEG is decoded at a reduced scale; every other format is decoded at full size, so it gets a lower cap,
+# and all downloads together decode no more than DECODE_PIXEL_BUDGET pixels at a time
+MAX_DECODE_PIXELS = int(os.getenv('PICREW_MAX_DECODE_PIXELS', str(4096 * 4096)))
+DECODE_PIXEL_BUDGET = int(os.getenv('PICREW_DECODE_PIXEL_BUDGET', str(MAX_DECODE_PIXELS)))
+TILE_CACHE_BYTES = int(os.getenv('PICREW_TILE_CACHE_BYTES', str(256 * 1024 * 1024)))
+
+# Attachments Pillow cannot open (gifv is an MP4); only their still preview is fetched
+PREVIEW_ONLY_TYPES = {'gifv', 'video', 'audio'}
+# Responses that never decode, rejected before their body is read
+REJECTED_CONTENT_TYPES = ('video/', 'audio/', 'text/html')
+GIF_HEADER_SIZE = 10  # signature and the logical screen width and height
+
+tile_cache = TileCache(common.TILE_CACHE_PATH, TILE_CACHE_BYTES)
+
+logger = logging.getLogger(__name__)
+
+
+class ImageRejected(Exception):
+    pass
+
+
+Entries = list[tuple[str, Image.Image | None]]  # full_acct, tile
+Images = tuple[list[bytes], list[bytes]]  # question pages, answer pages
+
+
+@dataclass(frozen=True)
+class Layout:
+    cols: int
+    rows: int
+    cell_size: int
 
-def generate_images(attachments: list[tuple[str, MediaAttachment]]):
-    count = len(attachments)
+    @classmethod
+    def for_count(cls, count: int) -> 'Layout':
+        cols, rows = grid(count)
+        return cls(cols, rows, max(fit_cell_size(cols, rows), MIN_CELL_SIZE))
+
+    @property
+    def canvas_size(self) -> tuple[int, int]:
+        return (
+            self.cols * (self.cell_size + CELL_GAP) + CELL_GAP,
+            self.rows * (self.cell_size + CELL_GAP) + CELL_GAP,
+        )
+
+    def position(self, index: int) -> tuple[int, int]:
+        return (
+            index % self.cols * (self.cell_size + CELL_GAP) + CELL_GAP,
+            index // self.cols * (self.cell_size + CELL_GAP) + CELL_GAP,
+        )
+
+
+def grid(count: int) -> tuple[int, int]:
     cols = math.ceil(count ** 0.5)
     rows = math.ceil(count / cols)
+    return cols, rows
+
+
+def fit_cell_size(cols: int, rows: int) -> int:
+    """The largest cell up to CELL_SIZE that keeps the grid within CANVAS_SIZE"""
+    return min((CANVAS_SIZE - CELL_GAP) // max(cols, rows) - CELL_GAP, CELL_SIZE)
+
+
+def paginate(count: int) -> list[range]:
+    """Split entry indexes over the fewest pages whose cells stay at least MIN_CELL_SIZE"""
+    pages = 1
+    while pages < MAX_PAGES and fit_cell_size(*grid(math.ceil(count / pages))) < MIN_CELL_SIZE:
+        pages += 1
+
+    per_page = math.ceil(count / pages)
+    return [range(start, min(start + per_page, count)) for start in range(0, count, per_page)]
+
 
+def generate_images(
+        attachments: list[tuple[str, MediaAttachment]],
+        render: Callable[[Entries], Images] | None = None) -> Images:
+    """Fetch the tiles here, then render them with render (in process by default)
+
+    Returns the encoded question and answer pages.
+    """
     random.shuffle(attachments)
+    with metrics.FETCH_SECONDS.time():
+        tiles = fetch_tiles([attachment for _, attachment in attachments])
+    entries = [(acct, tile) for (acct, _), tile in zip(attachments, tiles)]
 
-    canvas_width = cols * (CELL_SIZE + CELL_GAP) + CELL_GAP
-    canvas_height = rows * (CELL_SIZE + CELL_GAP) + CELL_GAP
+    with metrics.RENDER_SECONDS.time():
+        return (render or render_to_bytes)(entries)
 
-    question_canvas = Image.new('RGBA', (canvas_width, canvas_height), 'white')
-    answer_canvas = question_canvas.copy()
 
-    question_draw = ImageDraw.Draw(question_canvas)
-    answer_draw = ImageDraw.Draw(answer_canvas)
-    answer_font = ImageFont.truetype(FONT_PATH, ANSWER_FONT_SIZE)
-    number_font = ImageFont.truetype(FONT_PATH, NUMBER_FONT_SIZE)
+def save_images(images: list[bytes], paths: list[str]):
+    for path, data in zip(paths, images):
+        with open(path, 'wb') as f:
+            f.write(data)
 
-    for i, (acct, attachment) in enumerate(attachments):
-        row = i // cols
-        col = i % cols
-        number_caption = f'{i + 1:d}'
 
-        x = col * (CELL_SIZE + CELL_GAP) + CELL_GAP
-        y = row * (CELL_SIZE + CELL_GAP) + CELL_GAP
+def render_to_bytes(entries: Entries) -> Images:
+    """Render every page of entries; numbers run on across pages"""
+    questions, answers = [], []
+    for indexes in paginate(len(entries)):
+        question, answer = render_page(entries, indexes)
+        questions.append(question)
+        answers.append(answer)
+    return questions, answers
 
-        image = download_image(attachment)
-        if not image:
-            continue
 
-        # Convert to RGBA to handle transparency properly
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
+def render_page(entries: Entries, indexes: range) -> tuple[bytes, bytes]:
+    """Render the question image, then draw the name labels over it for the answer
 
-        image = image.resize((CELL_SIZE, CELL_SIZE))
+    Only one RGB canvas is ever allocated; the question is encoded before
+    any label touches it. Returns the encoded question and answer images.
+    """
+    layout = Layout.for_count(len(indexes))
+    cell_size = layout.cell_size
 
+    canvas = Image.new('RGB', layout.canvas_size, 'white')
+    draw = ImageDraw.Draw(canvas)
+    answer_font_size = round(cell_size * ANSWER_FONT_RATIO)
 
-        # Use alpha channel as mask for transparency
-        question_canvas.paste(image, (x, y), image)
-        answer_canvas.paste(image, (x, y), image)
+    positions: list[tuple[str, int, int]] = []
+    for cell, i in enumerate(indexes):
+        acct, image = entries[i]
+        x, y = layout.position(cell)
 
-        number_text_opts = {
-            'xy': (x + CELL_SIZE / 2, y - CELL_GAP / 2),
-            'text': number_caption,
-            'font': number_font,
-            'anchor': 'mm',
-        }
+        if not image:
+            continue
 
-        question_draw.text(**number_text_opts, fill=FONT_COLOR)  # type: ignore
-        answer_draw.text(**number_text_opts, fill=FONT_COLOR)  # type: ignore
+        if image.width != cell_size:
+            image = image.resize((cell_size, cell_size), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        canvas.paste(image, (x, y))
+        number = fonts.number_sprite(i + 1, FONT_PATH, NUMBER_FONT_SIZE, FONT_COLOR)
+        left, top, _, _ = fonts.centered_box(number, (x + cell_size / 2, y - CELL_GAP / 2))
+        canvas.paste(number, (left, top), number)
+        positions.append((acct, x, y))
 
-        answer_text_opts = {
-            'xy': (x + CELL_SIZE * NAME_POSITION[0], y + CELL_SIZE * NAME_POSITION[1]),
-            'text': acct,
-            'font': answer_font,
-            'anchor': 'mm',
-        }
+    question = encode(canvas)
 
-        text_size = answer_draw.textbbox(**answer_text_opts)
+    for acct, x, y in positions:
+        name = fonts.text_sprite(acct, FONT_PATH, answer_font_size, FONT_COLOR)
+        text_size = fonts.centered_box(name, (x + cell_size * NAME_POSITION[0], y + cell_size * NAME_POSITION[1]))
         box_size = (
             text_size[0] - FONT_GAP,
             text_size[1] - FONT_GAP,
@@ -87,28 +201,298 @@ def generate_images(attachments: list[tuple[str, MediaAttachment]]):
             text_size[3] + FONT_GAP,
         )
 
-        answer_draw.rectangle(box_size, fill=FONT_BACKGROUND,
-                              outline=FONT_COLOR, width=2)
+        draw.rectangle(box_size, fill=FONT_BACKGROUND,
+                       outline=FONT_COLOR, width=2)
 
-        answer_draw.text(**answer_text_opts, fill=FONT_COLOR)  # type: ignore
+        canvas.paste(name, text_size[:2], name)
 
-    question_canvas = question_canvas.convert('RGB')
-    answer_canvas = answer_canvas.convert('RGB')
-    question_canvas.save(common.QUESTION_IMAGE_PATH)
-    answer_canvas.save(common.ANSWER_IMAGE_PATH)
+    answer = encode(canvas)
 
+    return question, answer
 
-def download_image(attachment: MediaAttachment) -> Image.Image | None:
-    for url in [attachment.remote_url, attachment.url, attachment.preview_url]:
-        if not url:
-            continue
 
+def encode(image: Image.Image) -> bytes:
+    """Encode with the configured settings, trading quality for size if IMAGE_MAX_BYTES is set"""
+    start = time.perf_counter()
+    if IMAGE_MAX_DIMENSION and max(image.size) > IMAGE_MAX_DIMENSION:
+        scale = IMAGE_MAX_DIMENSION / max(image.size)
+        size = (round(image.width * scale), round(image.height * scale))
+        image = image.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    quality = IMAGE_QUALITY
+    data = encode_with_quality(image, quality)
+    attempts = 1
+    if IMAGE_MAX_BYTES and len(data) > IMAGE_MAX_BYTES and has_quality():
+        quality, data, attempts = fit_quality(image, data)
+        attempts += 1
+
+    elapsed = time.perf_counter() - start
+    metrics.ENCODE_SECONDS.observe(elapsed)
+    logger.info(
+        f'Encoded {image.width}x{image.height} {IMAGE_FORMAT} at quality {quality}: '
+        f'{len(data)} bytes in {elapsed:.2f}s ({attempts} attempts)')
+    return data
+
+
+def has_quality() -> bool:
+    """Whether the quality setting changes the encoded size"""
+    return IMAGE_FORMAT == 'JPEG' or (IMAGE_FORMAT == 'WEBP' and not IMAGE_LOSSLESS)
+
+
+def fit_quality(image: Image.Image, data: bytes) -> tuple[int, bytes, int]:
+    """Binary search the highest quality under IMAGE_MAX_BYTES
+
+    data is the encoding at IMAGE_QUALITY, known to be too large. Falls
+    back to the smallest encoding found if none fits. Returns the quality,
+    the encoded image and the number of encodes it took.
+    """
+    best: tuple[int, bytes] | None = None
+    smallest = (IMAGE_QUALITY, data)
+    attempts = 0
+
+    low, high = IMAGE_MIN_QUALITY, IMAGE_QUALITY - 1
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode_with_quality(image, quality)
+        attempts += 1
+        if len(data) <= IMAGE_MAX_BYTES:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            if len(data) < len(smallest[1]):
+                smallest = (quality, data)
+            high = quality - 1
+
+    if best is None:
+        logger.warning(f'Image does not fit in {IMAGE_MAX_BYTES} bytes even at quality {smallest[0]}')
+        best = smallest
+    return *best, attempts
+
+
+def encode_with_quality(image: Image.Image, quality: int) -> bytes:
+    options: dict = {}
+    if IMAGE_FORMAT == 'WEBP':
+        options = {'quality': quality, 'method': IMAGE_METHOD, 'lossless': IMAGE_LOSSLESS}
+    elif IMAGE_FORMAT == 'JPEG':
+        options = {'quality': quality}
+
+    buffer = io.BytesIO()
+    image.save(buffer, IMAGE_FORMAT, **options)
+    return buffer.getvalue()
+
+
+def create_client() -> httpx.Client:
+    limits = httpx.Limits(
+        max_connections=DOWNLOAD_CONCURRENCY,
+        max_keepalive_connections=DOWNLOAD_CONCURRENCY,
+    )
+    return httpx.Client(timeout=DOWNLOAD_TIMEOUT, limits=limits)
+
+
+def fetch_tiles(attachments: list[MediaAttachment]) -> list[Image.Image | None]:
+    """Download all attachments concurrently over one pooled client, keeping order
+
+    Every image is shrunk to a tile inside its worker, so at most one full
+    sized decode per worker is alive at any time. Tiles already in the tile
+    cache are not downloaded again.
+    """
+    tiles = [tile_cache.get(tile_key(attachment), CELL_SIZE) for attachment in attachments]
+    missing = [i for i, tile in enumerate(tiles) if tile is None]
+    if not missing:
+        return tiles
+
+    with create_client() as client, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY) as executor:
+        downloaded = executor.map(lambda i: download_tile(attachments[i], client), missing)
+        for i, tile in zip(missing, downloaded):
+            tiles[i] = tile
+
+    return tiles
+
+
+class TilePrefetcher:
+    """Fill the tile cache in the background as entries arrive"""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix='prefetch')
+        self.client = create_client()
+        self.pending: set[Future] = set()
+
+    def submit(self, attachments: list[MediaAttachment]):
+        for attachment in attachments:
+            future = self.executor.submit(self.prefetch, attachment)
+            self.pending.add(future)
+            future.add_done_callback(self.pending.discard)
+
+    def prefetch(self, attachment: MediaAttachment):
+        if tile_cache.get(tile_key(attachment), CELL_SIZE) is None:
+            download_tile(attachment, self.client)
+
+    def wait(self, timeout: float | None = None):
+        """Block until everything submitted so far is in the cache"""
+        wait(list(self.pending), timeout=timeout)
+
+
+def tile_key(attachment: MediaAttachment) -> str:
+    source = attachment.id or attachment.remote_url or attachment.url
+    return TileCache.key(str(source), CELL_SIZE)
+
+
+def download_tile(attachment: MediaAttachment, client: httpx.Client | None = None) -> Image.Image | None:
+    if client is None:
+        with create_client() as client:
+            return download_tile(attachment, client)
+
+    start = time.perf_counter()
+    for url in source_urls(attachment):
         try:
-            response = httpx.get(url)
-            response.raise_for_status()
-            image = Image.open(io.BytesIO(response.content))
-            return image
+            tile = fetch_tile(client, url)
         except Exception:
-            pass
+            continue
+        metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - start, result='ok')
+        tile_cache.put(tile_key(attachment), tile)
+        return tile
 
+    metrics.DOWNLOAD_SECONDS.observe(time.perf_counter() - start, result='failed')
     return None
+
+
+def make_tile(image: Image.Image) -> Image.Image:
+    """Resize to a cell and flatten any transparency onto white"""
+    if 'A' not in image.getbands() and 'transparency' not in image.info:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return image.resize((CELL_SIZE, CELL_SIZE), reducing_gap=3.0)
+
+    # Convert to RGBA to handle transparency properly
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+
+    image = image.resize((CELL_SIZE, CELL_SIZE), reducing_gap=3.0)
+
+    tile = Image.new('RGB', image.size, 'white')
+    tile.paste(image, mask=image)
+    return tile
+
+
+def source_urls(attachment: MediaAttachment) -> list[str]:
+    """Where to fetch an attachment from, cheapest usable source first"""
+    if attachment.type in PREVIEW_ONLY_TYPES:
+        urls = [attachment.preview_url]
+    else:
+        urls = [attachment.remote_url, attachment.url, attachment.preview_url]
+        # meta is typed as always there, but remote attachments may come without it
+        meta: MediaAttachmentMetadataContainer | None = attachment.meta
+        small = meta.get('small') if meta else None
+        if small and small.get('width', 0) >= CELL_SIZE and small.get('height', 0) >= CELL_SIZE:
+            # The preview is already big enough for a tile
+            urls.insert(0, attachment.preview_url)
+    return list(dict.fromkeys(url for url in urls if url))
+
+
+def fetch_tile(client: httpx.Client, url: str) -> Image.Image:
+    with client.stream('GET', url) as response:
+        response.raise_for_status()
+
+        content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+        if content_type.startswith(REJECTED_CONTENT_TYPES):
+            raise ImageRejected(f'Not an image: {content_type}')
+
+        content_length = response.headers.get('content-length')
+        if content_length and int(content_length) > MAX_DOWNLOAD_BYTES:
+            raise ImageRejected(f'Body too large: {content_length} bytes')
+
+        if content_type == 'image/gif':
+            return read_first_frame(response)
+        body = read_body(response)
+
+    return decode_tile(body)
+
+
+def read_body(response: httpx.Response) -> bytes:
+    body = bytearray()
+    for chunk in response.iter_bytes():
+        body += chunk
+        if len(body) > MAX_DOWNLOAD_BYTES:
+            raise ImageRejected(f'Body exceeds {MAX_DOWNLOAD_BYTES} bytes')
+
+    metrics.DOWNLOAD_BYTES.observe(len(body))
+    return bytes(body)
+
+
+def read_first_frame(response: httpx.Response) -> Image.Image:
+    """Decode a GIF as it arrives, stop reading after its first frame and tile it
+
+    Only the first frame ends up in a tile, and it is usually a small part
+    of an animation.
+    """
+    parser = ImageFile.Parser()
+    header = b''
+    received = 0
+    with contextlib.ExitStack() as stack:
+        for chunk in response.iter_bytes():
+            received += len(chunk)
+            if received > MAX_DOWNLOAD_BYTES:
+                raise ImageRejected(f'Body exceeds {MAX_DOWNLOAD_BYTES} bytes')
+
+            if len(header) < GIF_HEADER_SIZE:
+                # The parser allocates the frame as soon as it sees the header, so check the size first
+                header += chunk[:GIF_HEADER_SIZE - len(header)]
+                if len(header) == GIF_HEADER_SIZE:
+                    width, height = struct.unpack('<HH', header[6:])
+                    check_size(width, height, MAX_DECODE_PIXELS)
+                    stack.enter_context(decode_budget.reserve(width * height))
+
+            parser.feed(chunk)
+            if parser.finished:
+                break
+
+        metrics.DOWNLOAD_BYTES.observe(received)
+        return make_tile(parser.close())
+
+
+def decode_tile(data: bytes) -> Image.Image:
+    # Only the header is parsed here
+    image = Image.open(io.BytesIO(data))
+    check_size(*image.size, MAX_IMAGE_PIXELS)
+
+    # Let JPEG decode at 1/2, 1/4 or 1/8 scale, still no smaller than a cell; the size is now what gets decoded
+    image.draft(None, (CELL_SIZE, CELL_SIZE))
+    check_size(*image.size, MAX_DECODE_PIXELS)
+
+    # Decode here so the work happens in the fetching thread; animations load their first frame only.
+    # The full sized image is gone once it is tiled, so that is when its pixels are given back
+    with decode_budget.reserve(image.width * image.height):
+        image.load()
+        return make_tile(image)
+
+
+def check_size(width: int, height: int, limit: int):
+    if width * height > limit:
+        raise ImageRejected(f'Image too large: {width}x{height}')
+
+
+class DecodeBudget:
+    """Pixels that may be decoded at once across all download threads"""
+
+    def __init__(self, pixels: int):
+        self.pixels = pixels
+        self.available = pixels
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, pixels: int):
+        # An image bigger than the whole budget waits until it has all of it
+        pixels = min(pixels, self.pixels)
+        with self.condition:
+            self.condition.wait_for(lambda: self.available >= pixels)
+            self.available -= pixels
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.available += pixels
+                self.condition.notify_all()
+
+
+decode_budget = DecodeBudget(DECODE_PIXEL_BUDGET)
@@ -0,0 +1,119 @@
+import functools
+import logging
+import math
+import os
+import unicodedata
+
+from PIL import Image, ImageDraw, ImageFont
+
+# Fonts to take glyphs from when the main font lacks them, e.g. Hangul or emoji in account names
+FALLBACK_FONT_PATHS = os.getenv(
+    'PICREW_FALLBACK_FONTS',
+    os.pathsep.join([
+        '/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc',
+        '/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf',
+    ])).split(os.pathsep)
+# Color emoji fonts are bitmaps in this size only; they are scaled to the requested size
+BITMAP_FONT_SIZE = 109
+# Size at which glyphs are compared against the missing-glyph box
+PROBE_SIZE = 32
+# A noncharacter that no font maps, so it always renders as the missing-glyph box
+MISSING_CHAR = '\U0010FFFF'
+# Numbers are drawn on every render, so their sprites are kept; names are new every festival
+NUMBER_SPRITE_CACHE_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+Font = tuple[ImageFont.FreeTypeFont, float]  # font, scale to the requested size
+
+
+@functools.cache
+def get_font(path: str, size: int) -> Font:
+    """Load a font once per process"""
+    try:
+        return ImageFont.truetype(path, size), 1.0
+    except OSError:
+        # Bitmap fonts cannot be loaded at any other size
+        return ImageFont.truetype(path, BITMAP_FONT_SIZE), size / BITMAP_FONT_SIZE
+
+
+@functools.cache
+def font_chain(path: str) -> tuple[str, ...]:
+    fallbacks = [fallback for fallback in FALLBACK_FONT_PATHS if fallback and fallback != path]
+    return (path, *[fallback for fallback in fallbacks if os.path.exists(fallback)])
+
+
+@functools.lru_cache(maxsize=4096)
+def has_glyph(path: str, char: str) -> bool:
+    try:
+        return glyph_image(path, char) != glyph_image(path, MISSING_CHAR)
+    except OSError as e:
+        logger.warning(f'Cannot render with {path}: {e}')
+        return False
+
+
+@functools.lru_cache(maxsize=64)
+def glyph_image(path: str, char: str) -> tuple[tuple[int, int], bytes]:
+    font, _ = get_font(path, PROBE_SIZE)
+    left, top, right, bottom = font.getbbox(char)
+    image = Image.new('RGBA', (max(math.ceil(right - left), 1), max(math.ceil(bottom - top), 1)))
+    ImageDraw.Draw(image).text((-left, -top), char, font=font, fill='black', embedded_color=True)
+    return image.size, image.tobytes()
+
+
+def split_runs(text: str, paths: tuple[str, ...]) -> list[tuple[str, str]]:
+    """Split text into runs of characters drawn with the same font"""
+    runs: list[tuple[str, str]] = []
+    for char in text:
+        if runs and (char.isspace() or unicodedata.category(char) in ('Mn', 'Me', 'Cf')):
+            # Spaces, combining marks, joiners and variation selectors stay with what precedes them
+            path = runs[-1][0]
+        else:
+            path = next((path for path in paths if has_glyph(path, char)), paths[0])
+
+        if runs and runs[-1][0] == path:
+            runs[-1] = (path, runs[-1][1] + char)
+        else:
+            runs.append((path, char))
+    return runs
+
+
+def text_sprite(text: str, path: str, size: int, color: str) -> Image.Image:
+    """text drawn on a transparent background, taking missing glyphs from the fallback fonts
+
+    The height spans the ascent and descent of every font used.
+    """
+    parts: list[tuple[Image.Image, int]] = []  # image, ascent
+    for run_path, run in split_runs(text, font_chain(path)):
+        font, scale = get_font(run_path, size)
+        ascent, descent = font.getmetrics()
+        part = Image.new('RGBA', (max(math.ceil(font.getlength(run)), 1), ascent + descent))
+        ImageDraw.Draw(part).text((0, ascent), run, font=font, fill=color, anchor='ls', embedded_color=True)
+        if scale != 1.0:
+            part = part.resize(
+                (max(round(part.width * scale), 1), max(round(part.height * scale), 1)),
+                Image.Resampling.LANCZOS)
+            ascent = round(ascent * scale)
+        parts.append((part, ascent))
+
+    top = max((ascent for _, ascent in parts), default=0)
+    bottom = max((part.height - ascent for part, ascent in parts), default=0)
+    sprite = Image.new('RGBA', (max(sum(part.width for part, _ in parts), 1), max(top + bottom, 1)))
+    x = 0
+    for part, ascent in parts:
+        sprite.paste(part, (x, top - ascent))
+        x += part.width
+    return sprite
+
+
+@functools.lru_cache(maxsize=NUMBER_SPRITE_CACHE_SIZE)
+def number_sprite(number: int, path: str, size: int, color: str) -> Image.Image:
+    """The sprite of a number, cached per process and shared, so callers must only paste it"""
+    return text_sprite(f'{number:d}', path, size, color)
+
+
+def centered_box(sprite: Image.Image, center: tuple[float, float]) -> tuple[int, int, int, int]:
+    """The box sprite covers when centered on center"""
+    left = round(center[0] - sprite.width / 2)
+    top = round(center[1] - sprite.height / 2)
+    return left, top, left + sprite.width, top + sprite.height
@@ -2,6 +2,7 @@ HASHTAGS = ['#픽락관']
 HASHTAGS_LINE = '\n\n' + ' '.join(HASHTAGS) if HASHTAGS else ''
 
 ALREADY_RUNNING = "이미 진행중인 픽락관이 있습니다"
+TOO_MANY_RUNNING = "진행중인 픽락관이 너무 많습니다. 나중에 다시 시도해주세요"
 NO_RUNNING = "진행중인 픽락관이 없습니다"
 NOT_IN_PREPARE = "참가신청이 마감되었습니다"
 
@@ -0,0 +1,208 @@
+import abc
+import bisect
+import contextlib
+import http.server
+import logging
+import math
+import os
+import threading
+import time
+
+# Serve /metrics on this port; 0 to not serve metrics
+METRICS_PORT = int(os.getenv('PICREW_METRICS_PORT', '0'))
+METRICS_ADDRESS = os.getenv('PICREW_METRICS_ADDRESS', '127.0.0.1')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Lateness is negative when a phase is posted early
+LATENESS_BUCKETS = (-60, -10, -1, 0, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = tuple(2 ** power for power in range(10, 25, 2))  # 1 KiB to 16 MiB
+
+logger = logging.getLogger(__name__)
+
+REGISTRY: dict[str, 'Metric'] = {}
+
+# Observations made while captured() is active, instead of being recorded here
+capture: list[tuple[str, tuple, float]] | None = None
+
+
+class Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def key(self, labels: dict[str, str]) -> tuple:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key: tuple, extra: dict[str, str] | None = None) -> str:
+        pairs = list(zip(self.labels, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{escape(value)}"' for label, value in pairs) + '}'
+
+    @abc.abstractmethod
+    def add(self, key: tuple, value: float):
+        """Record value under the label values in key"""
+
+    def expose(self) -> list[str]:
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}', *self.samples()]
+
+    @abc.abstractmethod
+    def samples(self) -> list[str]:
+        """Exposition lines of every labelled value"""
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        if capture is not None:
+            capture.append((self.name, key, amount))
+            return
+        self.add(key, amount)
+
+    def add(self, key: tuple, amount: float):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{self.format_labels(key)} {format_value(value)}' for key, value in values]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = SECONDS_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        self.values: dict[tuple, tuple[list[int], list[float]]] = {}  # bucket counts (+Inf last), [sum]
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        if capture is not None:
+            capture.append((self.name, key, value))
+            return
+        self.add(key, value)
+
+    def add(self, key: tuple, value: float):
+        with self.lock:
+            counts, total = self.values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the block takes, whether or not it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        with self.lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self.values.items())
+
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self.format_labels(key, {"le": format_value(bound)})} {cumulative}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {cumulative}')
+        return lines
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+@contextlib.contextmanager
+def captured():
+    """Collect the observations of the block to be replayed in another process"""
+    global capture
+    observations: list[tuple[str, tuple, float]] = []
+    capture = observations
+    try:
+        yield observations
+    finally:
+        capture = None
+
+
+def replay(observations: list[tuple[str, tuple, float]]):
+    for name, key, value in observations:
+        REGISTRY[name].add(key, value)
+
+
+def expose() -> str:
+    return '\n'.join(line for metric in list(REGISTRY.values()) for line in metric.expose()) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = expose().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port: int = METRICS_PORT, address: str = METRICS_ADDRESS) -> http.server.ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread"""
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f'Serving metrics on http://{address}:{server.server_port}/metrics')
+    return server
+
+
+API_SECONDS = Histogram(
+    'picrew_api_request_seconds', 'Mastodon API requests by endpoint, retries counted separately', ('endpoint',))
+API_ERRORS = Counter('picrew_api_errors_total', 'Mastodon API calls that failed for good', ('endpoint',))
+API_RETRIES = Counter('picrew_api_retries_total', 'Mastodon API requests that were retried', ('endpoint',))
+API_COALESCED = Counter(
+    'picrew_api_coalesced_total', 'Mastodon API reads answered by an identical one in flight', ('endpoint',))
+
+DOWNLOAD_SECONDS = Histogram('picrew_download_seconds', 'Entry image downloads, until the body is read', ('result',))
+DOWNLOAD_BYTES = Histogram(
+    'picrew_download_bytes', 'Size of downloaded entry images', buckets=BYTES_BUCKETS)
+FETCH_SECONDS = Histogram('picrew_fetch_tiles_seconds', 'Getting all tiles of a render, downloads included')
+RENDER_SECONDS = Histogram('picrew_render_seconds', 'Rendering and encoding all pages of a festival')
+ENCODE_SECONDS = Histogram('picrew_encode_seconds', 'Encoding one question or answer page')
+
+UPLOAD_SECONDS = Histogram('picrew_media_upload_seconds', 'Uploading a rendered image')
+PROCESSING_SECONDS = Histogram(
+    'picrew_media_processing_seconds', 'Waiting for the server to process an uploaded image')
+
+LATENESS_SECONDS = Histogram(
+    'picrew_phase_lateness_seconds', 'When a phase was posted against its schedule', ('phase',), LATENESS_BUCKETS)
+JOB_SECONDS = Histogram('picrew_job_seconds', 'Festival jobs, such as prepare_end or reveal_answer', ('job',))
+LOOP_SECONDS = Histogram('picrew_loop_seconds', 'Work done per iteration of the main loop, sleeping excluded')
@@ -0,0 +1,101 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from . import common
+from . import drawer
+from . import metrics
+
+RENDER_WORKERS = int(os.getenv('PICREW_RENDER_WORKERS', '2'))
+RENDER_TIMEOUT = float(os.getenv('PICREW_RENDER_TIMEOUT', '120'))
+# How often idle work is done while waiting for a render
+RENDER_IDLE_SECONDS = float(os.getenv('PICREW_RENDER_IDLE_SECONDS', '5'))
+
+logger = logging.getLogger(__name__)
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderPool:
+    """Render question/answer images in worker processes
+
+    Pillow holds the GIL through resizing, text layout and encoding, so
+    rendering in a thread would still stall the bot. A render that times
+    out has its workers killed, and a crashed worker only fails that
+    render; either way the next render gets a fresh pool.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, timeout: float = RENDER_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.executor: ProcessPoolExecutor | None = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.executor is None:
+                # Do not fork a process that is running threads
+                context = multiprocessing.get_context('spawn')
+                # Workers log encode times through the same handler setup as the bot
+                level = logging.getLogger(__package__).getEffectiveLevel()
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=common.setup_logging,
+                    initargs=(level,))
+            return self.executor
+
+    def render(self, entries: drawer.Entries, idle: Callable[[], object] | None = None) -> drawer.Images:
+        """Render in a worker; meanwhile call idle every RENDER_IDLE_SECONDS, if given"""
+        executor = self.get_executor()
+        future = executor.submit(render_job, entries)
+        deadline = time.monotonic() + self.timeout
+        try:
+            while idle and not wait([future], timeout=RENDER_IDLE_SECONDS).done and time.monotonic() < deadline:
+                try:
+                    idle()
+                except Exception as e:
+                    logger.warning(f'Failed while waiting for a render: {e!r}')
+            images, observations = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            logger.error(f'Render timed out after {self.timeout}s')
+            self.reset(executor)
+            raise RenderError('Render timed out')
+        except BrokenProcessPool as e:
+            logger.error('Render worker crashed')
+            self.reset(executor)
+            raise RenderError('Render worker crashed') from e
+
+        metrics.replay(observations)
+        return images
+
+    def reset(self, executor: ProcessPoolExecutor):
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+
+        # ProcessPoolExecutor cannot cancel a running call; kill its workers instead
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def render_job(entries: drawer.Entries) -> tuple[drawer.Images, list]:
+    """Render in a worker, returning the metrics it recorded for the bot's process"""
+    with metrics.captured() as observations:
+        images = drawer.render_to_bytes(entries)
+    return images, observations
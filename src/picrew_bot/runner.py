@@ -0,0 +1,162 @@
+import asyncio
+import datetime
+import logging
+import math
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mastodon.return_types import MediaAttachment
+
+from . import metrics
+from . import stream
+from .bot import Bot, FestivalConfig, MAX_FESTIVALS, MEDIA_PROCESSING_TIMEOUT, POLL_SECONDS
+
+ASYNC = os.getenv('PICREW_ASYNC', '0') == '1'
+
+
+class AsyncRunner:
+    """Drive a Bot from an event loop
+
+    Mastodon calls stay the blocking Bot methods and run in threads, one at
+    a time under a lock so the Bot state is never touched concurrently.
+    Rendering and waiting for media processing happen outside the lock, so
+    mentions keep being answered while a phase is in progress. Every
+    festival advances in its own task, so they render and upload in
+    parallel.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        self.render_executor = ThreadPoolExecutor(max_workers=MAX_FESTIVALS, thread_name_prefix='render')
+        self.tasks: dict = {}  # prepare_status_id: asyncio.Task
+
+    async def run(self):
+        self.lock = asyncio.Lock()
+        self.wakeup = asyncio.Event()
+        await asyncio.gather(self.notification_loop(), self.festival_loop())
+
+    async def call(self, func, *args):
+        """Run a blocking Bot method with exclusive access to its state"""
+        async with self.lock:
+            return await asyncio.to_thread(func, *args)
+
+    async def notification_loop(self):
+        mention_stream = None
+        if stream.STREAMING:
+            mention_stream = stream.MentionStream(self.bot.mastodon.api)
+            await asyncio.to_thread(mention_stream.start)
+            self.logger.info('Streaming notifications')
+
+        while True:
+            try:
+                if mention_stream is None or mention_stream.needs_backfill():
+                    await self.call(self.bot.check_notifications)
+                    await self.call(self.bot.save)
+                    self.wakeup.set()
+
+                if mention_stream is None:
+                    await asyncio.sleep(POLL_SECONDS)
+                elif notification := await asyncio.to_thread(mention_stream.get, POLL_SECONDS):
+                    if mention_stream.needs_backfill():
+                        # It came after a reconnect; what the stream missed is older and goes first
+                        await self.call(self.bot.check_notifications)
+                    await self.call(self.bot.handle_streamed, notification)
+                    await self.call(self.bot.save)
+                    self.wakeup.set()
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.error('Error occurred. But continue to run')
+                await asyncio.sleep(POLL_SECONDS)
+
+    async def festival_loop(self):
+        while True:
+            try:
+                await self.check_festival()
+            except Exception as e:
+                self.logger.exception(e)
+                self.logger.error('Error occurred. But continue to run')
+
+            timeout = self.bot.seconds_until_wakeup(POLL_SECONDS)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def check_festival(self):
+        for key, festival in list(self.bot.festivals.items()):
+            if (task := self.tasks.get(key)) and not task.done():
+                continue
+            self.tasks[key] = asyncio.create_task(self.advance(festival))
+
+        for key in [key for key, task in self.tasks.items() if task.done()]:
+            del self.tasks[key]
+
+    async def advance(self, festival: FestivalConfig):
+        now = datetime.datetime.now().astimezone()
+        try:
+            done: set[str] = set()
+            while (job := self.bot.next_due_job(festival, now)) and job not in done:
+                done.add(job)
+                with metrics.JOB_SECONDS.time(job=job):
+                    if handler := getattr(self, job, None):
+                        await handler(festival)
+                    else:
+                        await self.call(getattr(self.bot, job), festival)
+                await self.call(self.bot.save)
+        except Exception as e:
+            self.logger.exception(e)
+            self.logger.error('Error occurred. But continue to run')
+        finally:
+            self.wakeup.set()
+
+    async def prepare_end(self, festival: FestivalConfig):
+        images = await self.call(self.bot.close_entries, festival)
+        if images is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.render_executor, self.bot.render_images, festival, images)
+        questions = self.bot.post_images(festival.question_image_files())
+        answers = self.bot.post_images(festival.answer_image_files())
+        media = await self.wait_for_media(list(await asyncio.gather(*map(asyncio.wrap_future, questions))))
+        await self.call(self.bot.publish_question, festival, media)
+        await asyncio.wait(map(asyncio.wrap_future, answers))
+        self.bot.keep_answer_media(festival, answers)
+
+    async def prepare_answer_media(self, festival: FestivalConfig):
+        timeout = (festival.answer_reveal_at - datetime.datetime.now().astimezone()).total_seconds()
+        try:
+            await self.wait_for_media(await asyncio.to_thread(self.bot.answer_media, festival), max(timeout, 0))
+            festival.answer_media_ready = True
+        except Exception as e:
+            # Try again at reveal time
+            self.logger.warning(f'Answer media not ready ahead of the reveal: {e}')
+
+    async def reveal_answer(self, festival: FestivalConfig):
+        if not festival.answer_media_ready:
+            await self.wait_for_media(await asyncio.to_thread(self.bot.answer_media, festival))
+            festival.answer_media_ready = True
+        await self.call(self.bot.reveal_answer, festival)
+
+    async def wait_for_media(self, media: list[MediaAttachment], timeout: float = MEDIA_PROCESSING_TIMEOUT) \
+            -> list[MediaAttachment]:
+        """Same as Bot.wait_for_media, but without holding a thread"""
+        start = time.monotonic()
+        media = list(media)
+        try_count = 0
+        while pending := [i for i, attachment in enumerate(media) if not self.bot.media_processed(attachment)]:
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f'{len(pending)} media not processed in {timeout:.0f}s')
+            try_count += 1
+            await asyncio.sleep(min(math.log2(1 + try_count), remaining))
+            for i, attachment in zip(pending, await asyncio.gather(
+                    *(asyncio.to_thread(self.bot.mastodon.media, media[i]) for i in pending))):
+                media[i] = attachment
+
+        self.bot.log_processing(media, start)
+        return media
@@ -0,0 +1,82 @@
+import json
+import sqlite3
+import threading
+
+
+class StateStore:
+    """Bot state in SQLite, written only when something changed
+
+    Every save is one transaction in WAL mode, so a crash leaves either
+    the previous or the new state on disk, never a mix. Only rows whose
+    serialized value differs from what was last written are touched.
+    Ended festivals are kept as history instead of being deleted.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS festivals ('
+            ' id TEXT PRIMARY KEY,'
+            ' state TEXT NOT NULL,'
+            ' ended INTEGER NOT NULL DEFAULT 0)')
+        self.lock = threading.Lock()
+
+        # Serialized values as they are on disk
+        self.meta: dict[str, str] = {}
+        self.festivals: dict[str, str] = {}
+
+    def load(self) -> tuple[dict, list[dict]]:
+        """Return the meta values and the states of festivals that have not ended"""
+        with self.lock:
+            self.meta = dict(self.db.execute('SELECT key, value FROM meta').fetchall())
+            self.festivals = dict(self.db.execute('SELECT id, state FROM festivals WHERE ended = 0').fetchall())
+
+        meta = {key: json.loads(value) for key, value in self.meta.items()}
+        festivals = [json.loads(state) for state in self.festivals.values()]
+        return meta, festivals
+
+    def save(self, meta: dict, festivals: dict[str, dict]) -> bool:
+        """Write what changed since the last save; return whether anything was written"""
+        meta_changes = []
+        for key, value in meta.items():
+            serialized = json.dumps(value)
+            if self.meta.get(key) != serialized:
+                meta_changes.append((key, serialized))
+
+        festival_changes = []
+        for festival_id, state in festivals.items():
+            serialized = json.dumps(state, sort_keys=True)
+            if self.festivals.get(festival_id) != serialized:
+                festival_changes.append((festival_id, serialized))
+
+        ended = [(festival_id,) for festival_id in self.festivals if festival_id not in festivals]
+
+        if not (meta_changes or festival_changes or ended):
+            return False
+
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'INSERT INTO meta (key, value) VALUES (?, ?)'
+                    ' ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                    meta_changes)
+                self.db.executemany(
+                    'INSERT INTO festivals (id, state) VALUES (?, ?)'
+                    ' ON CONFLICT(id) DO UPDATE SET state = excluded.state, ended = 0',
+                    festival_changes)
+                self.db.executemany('UPDATE festivals SET ended = 1 WHERE id = ?', ended)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+            self.meta.update(meta_changes)
+            self.festivals.update(festival_changes)
+            for festival_id, in ended:
+                del self.festivals[festival_id]
+
+        return True
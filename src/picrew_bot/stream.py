@@ -0,0 +1,87 @@
+import logging
+import os
+import queue
+import threading
+
+import mastodon
+
+from mastodon.return_types import Notification
+
+STREAMING = os.getenv('PICREW_STREAMING', '0') == '1'
+RECONNECT_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class MentionListener(mastodon.StreamListener):
+    """Queue mentions from the user stream for the bot loop
+
+    Whenever a connection ends, cleanly or not, events may have been
+    missed, so it raises the gap flag and the bot backfills over REST.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mentions: queue.Queue[Notification] = queue.Queue()
+        self.gap = threading.Event()
+
+    def handle_stream(self, response):
+        try:
+            super().handle_stream(response)
+        finally:
+            self.gap.set()
+
+    def on_notification(self, notification: Notification):
+        if notification.type == 'mention':
+            self.mentions.put(notification)
+
+    def on_abort(self, err):
+        logger.warning(f'Stream aborted: {err}')
+        self.gap.set()
+
+    def on_unknown_event(self, name, unknown_event=None):
+        logger.debug(f'Unknown stream event: {name}')
+
+
+class MentionStream:
+
+    def __init__(self, client: mastodon.Mastodon):
+        self.client = client
+        self.listener = MentionListener()
+        self.handle = None
+
+    def start(self):
+        self.handle = self.client.stream_user(
+            self.listener,
+            run_async=True,
+            reconnect_async=True,
+            reconnect_async_wait_sec=RECONNECT_SECONDS)
+        # Whatever happened before the connection needs a backfill
+        self.listener.gap.set()
+
+    def close(self):
+        if self.handle:
+            self.handle.close()
+
+    def needs_backfill(self) -> bool:
+        """True once after every disconnect, and while the stream is down"""
+        if self.handle is None or not self.handle.is_alive():
+            logger.warning('Stream is dead, restarting')
+            self.start()
+        assert self.handle is not None
+
+        if not self.handle.is_receiving():
+            # Keep the flag so the first poll after reconnecting closes the gap
+            self.listener.gap.set()
+            return True
+
+        if self.listener.gap.is_set():
+            self.listener.gap.clear()
+            return True
+        return False
+
+    def get(self, timeout: float) -> Notification | None:
+        try:
+            return self.listener.mentions.get(timeout=timeout)
+        except queue.Empty:
+            return None
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = '.rgb'
+TMP_SUFFIX = '.tmp'
+# A temporary file this old was left by a crash, not a write in progress
+STALE_TMP_SECONDS = 60
+
+
+class TileCache:
+    """Size bounded LRU store of ready to paste RGB tiles on disk
+
+    Tiles are stored as raw RGB pixels, so a hit costs one read and no
+    decode. Files are written to a temporary name and renamed into place,
+    which keeps the cache consistent across crashes and between processes
+    sharing the directory. Recency is tracked with the file mtime.
+    Temporary files count towards the size, and those left behind by a
+    crash are deleted on eviction.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes: int | None = None
+
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(source: str, size: int) -> str:
+        return hashlib.sha256(f'{source}:{size}'.encode()).hexdigest()
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.path, key + SUFFIX)
+
+    def get(self, key: str, size: int) -> Image.Image | None:
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        if len(data) != size * size * 3:
+            # Partially written by something else; let the next put replace it
+            return None
+
+        try:
+            os.utime(filename)
+        except FileNotFoundError:
+            pass
+
+        return Image.frombytes('RGB', (size, size), data)
+
+    def put(self, key: str, tile: Image.Image):
+        assert tile.mode == 'RGB'
+        data = tile.tobytes()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.filename(key))
+        except OSError as e:
+            logger.warning(f'Failed to cache tile {key}: {e}')
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            return
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self.disk_usage()
+            else:
+                self.total_bytes += len(data)
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def disk_usage(self) -> int:
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith((SUFFIX, TMP_SUFFIX)):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def evict(self):
+        """Delete stale temporary files, then least recently used tiles until below the size limit"""
+        entries = []
+        writing = 0  # bytes of temporary files still being written
+        now = time.time()
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith((SUFFIX, TMP_SUFFIX)):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            if entry.name.endswith(SUFFIX):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            elif now - stat.st_mtime > STALE_TMP_SECONDS:
+                logger.info(f'Deleting stale {entry.name}')
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+            else:
+                writing += stat.st_size
+
+        entries.sort()
+        total = writing + sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        self.total_bytes = total